@@ -0,0 +1,650 @@
+import os
+import sys
+import argparse
+import datetime
+import json
+import math
+import resource
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+import zipfile
+import convert_csv
+import export
+import network_graph
+import performance_rollups
+import query
+from convert_csv import EXPORT_TYPES
+
+ACCOUNT_NUMBER = 123456789012
+FLEET_START = datetime.datetime(2017, 11, 4, 0, 1)
+FLEET_PORTS = [22, 443, 5432, 8080] # Ports the agents of a generated fleet connect to each other on
+FLEET_PROCESSES = 8 # Processes of each agent of a generated fleet
+RSS_SAMPLE_SECONDS = 0.05 # Interval at which run_convert samples the memory of this process and its workers
+
+# Athena SQL run by benchmark_query against each source, with the agentId and time range filled in from the fleet
+QUERIES = {"agent": "SELECT count(*) AS samples, avg(total_cpu_usage_pct) AS cpu FROM system_performance WHERE agent_id = '{agent}'",
+           "time-range": "SELECT agent_id, max(total_cpu_usage_pct) AS cpu FROM system_performance "
+                         "WHERE timestamp >= TIMESTAMP '{start}' AND timestamp < TIMESTAMP '{end}' GROUP BY agent_id",
+           "port": "SELECT agent_id, count(*) AS connections FROM destination_process_connection WHERE destination_port = 22 GROUP BY agent_id"}
+
+# Raised by FakeS3 like the ClientError boto3 raises for a missing object
+class FakeS3Error(Exception):
+    def __init__(self, code, message):
+        Exception.__init__(self, message)
+        self.response = {'Error': {'Code': code, 'Message': message}}
+
+# Stands in for the boto3 S3 client, keeping uploaded objects as files under root with their metadata beside them
+class FakeS3(object):
+    def __init__(self, root):
+        self.root = root
+
+    def upload_file(self, Filename, Bucket, Key, ExtraArgs=None, Callback=None, Config=None):
+        path = os.path.join(self.root, Bucket, Key)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        shutil.copyfile(Filename, path)
+        with open(path + ".metadata.json", 'w') as metadata_file:
+            json.dump({'Metadata': (ExtraArgs or {}).get('Metadata', {}), 'ETag': '"' + convert_csv.get_md5(path) + '"'}, metadata_file)
+
+    def head_object(self, Bucket, Key):
+        path = os.path.join(self.root, Bucket, Key)
+        if not os.path.isfile(path):
+            raise FakeS3Error("404", "Not Found")
+        with open(path + ".metadata.json") as metadata_file:
+            response = json.load(metadata_file)
+        response['ContentLength'] = os.path.getsize(path)
+        return response
+
+    def delete_object(self, Bucket, Key):
+        path = os.path.join(self.root, Bucket, Key)
+        for object_path in [path, path + ".metadata.json"]:
+            if os.path.isfile(object_path):
+                os.remove(object_path)
+
+# Returns the n-th agentId of a generated fleet
+def get_agent_id(n):
+    return str.format("o-{:017x}", n)
+
+# Returns a CSV value of the given column type of EXPORT_TYPES for row i of an agent
+def get_value(column_type, agent, i, timestamp):
+    if column_type == "bigint":
+        return str(ACCOUNT_NUMBER)
+    if column_type == "int":
+        return str(i % 64 + 1)
+    if column_type == "double":
+        return str.format("{:.2f}", (i * 7919) % 10000 / 100.0)
+    if column_type == "boolean":
+        return "true" if i % 2 else "false"
+    if column_type == "timestamp":
+        return timestamp.strftime('%Y-%m-%d %H:%M:%S')
+    return str.format("value-{}", i % 100)
+
+# Returns the IP address of the n-th agent of a generated fleet
+def get_agent_ip(n):
+    return str.format("10.{}.{}.{}", n // 65536 % 256, n // 256 % 256, n % 256)
+
+# Returns the values of the columns of row i of the n-th agent that tie the export types of a generated fleet together,
+# so connections resolve to agents and processes: each agent connects to the next three agents on FLEET_PORTS, and
+# every tenth connection goes to a host outside of the fleet. Hosts have 2 to 16 processors, 4GB of RAM per processor
+# and a load that depends on the agent and rises during working hours.
+def get_linked_values(export_type, n, i, num_agents, timestamp):
+    port_index = i % len(FLEET_PORTS)
+    if export_type == "networkInterface":
+        return {'ip_address': get_agent_ip(n)}
+    if export_type == "process":
+        return {'agent_assigned_process_id': str.format("p{}", i % FLEET_PROCESSES), 'name': str.format("process-{}", i % FLEET_PROCESSES)}
+    if export_type == "sourceProcessConnection":
+        destination_ip = get_agent_ip((n + 1 + i % 3) % num_agents) if i % 10 != 9 else str.format("203.0.113.{}", i % 256)
+        return {'source_ip': get_agent_ip(n), 'destination_ip': destination_ip, 'destination_port': str(FLEET_PORTS[port_index]),
+                'transport_protocol': "tcp", 'agent_assigned_process_id': str.format("p{}", FLEET_PROCESSES - 1 - i % 4)}
+    if export_type == "destinationProcessConnection":
+        source_ip = get_agent_ip((n - 1 - i % 3) % num_agents) if i % 10 != 9 else str.format("203.0.113.{}", i % 256)
+        return {'source_ip': source_ip, 'destination_ip': get_agent_ip(n), 'destination_port': str(FLEET_PORTS[port_index]),
+                'transport_protocol': "tcp", 'agent_assigned_process_id': str.format("p{}", port_index)}
+    if export_type == "systemPerformance":
+        processors = 2 ** (n % 4 + 1)
+        load = (n % 5 + 1) * (2 if 9 <= timestamp.hour < 18 else 1) * (1 + (i * 7919) % 10 / 10.0) / 20.0
+        return {'total_num_logical_processors': str(processors), 'total_num_cores': str(processors), 'total_num_cpus': str(processors // 2),
+                'total_cpu_usage_pct': str.format("{:.2f}", 100 * load), 'total_ram_in_mb': str(4096 * processors),
+                'total_free_ram_in_mb': str.format("{:.2f}", 4096 * processors * (1 - load))}
+    return {}
+
+# Writes a synthetic agentExports directory under dir_path with num_files CSV files of rows_per_file rows for each
+# export type (all by default) of num_agents agents, laid out and named like the files extracted by export.py.
+# Files are numbered from first_file, so later calls can add the exports of later days. Returns the path of agentExports.
+def generate_fleet(dir_path, num_agents, num_files, rows_per_file, export_types=EXPORT_TYPES, first_file=0):
+    exports_dir = os.path.join(dir_path, "agentExports")
+    for n in range(num_agents):
+        agent = get_agent_id(n)
+        for export_type in export_types:
+            type_dir = os.path.join(exports_dir, agent, export_type)
+            if not os.path.isdir(type_dir):
+                os.makedirs(type_dir)
+            for f in range(first_file, first_file + num_files):
+                start = FLEET_START + datetime.timedelta(days=3 * f)
+                file_name = str.format("{}_{}_{}.csv", start.strftime('%Y-%m-%dT%H%M%SZ'), ACCOUNT_NUMBER, export_type)
+                with open(os.path.join(type_dir, file_name), 'w') as csv_file:
+                    csv_file.write(",".join(name for (name, column_type) in EXPORT_TYPES[export_type]) + "\n")
+                    # Rows are spread over the 3 days of the file's export, like samples of consecutive exports
+                    write_rows(csv_file, export_type, n, num_agents,
+                               ((i, start + datetime.timedelta(seconds=3 * 24 * 3600 * i // rows_per_file)) for i in range(rows_per_file)))
+    return exports_dir
+
+# Writes a CSV row of an export type of the n-th agent of a generated fleet of num_agents agents to csv_file for each
+# (i, timestamp) in samples
+def write_rows(csv_file, export_type, n, num_agents, samples):
+    agent = get_agent_id(n)
+    for (i, timestamp) in samples:
+        values = [get_value(column_type, agent, i, timestamp) for (name, column_type) in EXPORT_TYPES[export_type]]
+        values[1] = agent
+        for (name, value) in get_linked_values(export_type, n, i, num_agents, timestamp).items():
+            values[[column[0] for column in EXPORT_TYPES[export_type]].index(name)] = value
+        csv_file.write(",".join(values) + "\n")
+
+# Raised by FakeDiscovery like the errors boto3 raises for the Discovery service, which export.py tells apart by name
+class OperationNotPermittedException(Exception):
+    pass
+
+class ThrottlingException(Exception):
+    pass
+
+# Stands in for the boto3 Discovery client of a generated fleet of num_agents agents that reported for num_days days
+# from FLEET_START, taking rows_per_day samples of each export type a day. Every call takes call_latency seconds and
+# is counted in stats. An export task finishes task_seconds after it was started, the service turns new export tasks
+# away while max_exports are running, and describe_export_tasks calls beyond calls_per_second (if given) are throttled.
+# The archive of an export is written to work_dir when the export first reports SUCCEEDED, laid out like the archives
+# of the service, and is downloaded from there. Exports of more than max_export_rows rows of an export type (if given)
+# end early, like the service cuts off large exports.
+class FakeDiscovery(object):
+    def __init__(self, work_dir, num_agents, num_days, rows_per_day, call_latency=0.0, task_seconds=1.0, max_exports=export.MAX_EXPORTS,
+                 calls_per_second=0, max_export_rows=0):
+        self.work_dir = work_dir
+        self.num_agents = num_agents
+        self.end_time = FLEET_START + datetime.timedelta(days=num_days)
+        self.sample_seconds = 24 * 3600 // rows_per_day
+        self.call_latency = call_latency
+        self.task_seconds = task_seconds
+        self.max_exports = max_exports
+        self.calls_per_second = calls_per_second
+        self.max_export_rows = max_export_rows
+        # Maps exportId to [agentIds, requested start, requested end, time it finishes, download URL once written]
+        self.tasks = {}
+        self.describe_times = [] # Times of the describe_export_tasks calls answered in the last second
+        self.stats = {'describe_agents_calls': 0, 'start_export_task_calls': 0, 'describe_export_tasks_calls': 0, 'concurrency_rejections': 0,
+                      'throttled_calls': 0, 'archives': 0, 'archive_bytes': 0, 'archive_rows': 0, 'generate_seconds': 0.0}
+
+    def call(self, operation):
+        self.stats[operation + '_calls'] += 1
+        time.sleep(self.call_latency)
+
+    def describe_agents(self, maxResults=100, nextToken=""):
+        self.call("describe_agents")
+        first = int(nextToken or 0)
+        last = min(first + maxResults, self.num_agents)
+        response = {'agentsInfo': [{'agentId': get_agent_id(n), 'agentType': "EC2", 'registeredTime': FLEET_START.strftime('%Y-%m-%dT%H:%M:%SZ'),
+                                    'lastHealthPingTime': self.end_time.strftime('%Y-%m-%dT%H:%M:%SZ')} for n in range(first, last)]}
+        if last < self.num_agents:
+            response['nextToken'] = str(last)
+        return response
+
+    def start_export_task(self, filters, startTime, endTime):
+        self.call("start_export_task")
+        now = time.time()
+        if len([task for task in self.tasks.values() if task[3] > now]) >= self.max_exports:
+            self.stats['concurrency_rejections'] += 1
+            raise OperationNotPermittedException("You have reached limit of maximum allowed concurrent exports. Please wait for current export tasks to finish before starting another.")
+        export_id = str.format("export-{:08d}", len(self.tasks))
+        self.tasks[export_id] = [filters[0]['values'], startTime, endTime, now + self.task_seconds, None]
+        return {'exportId': export_id}
+
+    def describe_export_tasks(self, exportIds, maxResults=100, nextToken=""):
+        self.call("describe_export_tasks")
+        now = time.time()
+        self.describe_times = [called for called in self.describe_times if called > now - 1]
+        if self.calls_per_second and len(self.describe_times) >= self.calls_per_second:
+            self.stats['throttled_calls'] += 1
+            raise ThrottlingException("Rate exceeded")
+        self.describe_times.append(now)
+        first = int(nextToken or 0)
+        response = {'exportsInfo': [self.get_export_info(export_id, now) for export_id in exportIds[first:first + maxResults]]}
+        if first + maxResults < len(exportIds):
+            response['nextToken'] = str(first + maxResults)
+        return response
+
+    def get_export_info(self, export_id, now):
+        (agents, start, end, finished, url) = self.tasks[export_id]
+        info = {'exportId': export_id, 'exportStatus': "IN_PROGRESS", 'statusMessage': "", 'requestedStartTime': start, 'requestedEndTime': end}
+        if now >= finished:
+            if url is None:
+                url = self.tasks[export_id][4] = self.write_archive(export_id, agents, start, end)
+            info.update({'exportStatus': "SUCCEEDED", 'configurationsDownloadUrl': url})
+        return info
+
+    # Writes the archive of an export of the agents from start to end: a CSV file of each export type holding the
+    # samples of the agents in that time, named <accountNumber>_<exportType>.csv, and the results file with the actual
+    # start and end of the export. Returns its URL.
+    def write_archive(self, export_id, agents, start, end):
+        started = time.time()
+        first = int(math.ceil((start - FLEET_START).total_seconds() / self.sample_seconds))
+        last = int(math.ceil((end - FLEET_START).total_seconds() / self.sample_seconds))
+        actual_end = end
+        if self.max_export_rows and last - first > self.max_export_rows:
+            last = first + self.max_export_rows
+            actual_end = FLEET_START + datetime.timedelta(seconds=last * self.sample_seconds)
+        samples = [(i, FLEET_START + datetime.timedelta(seconds=i * self.sample_seconds)) for i in range(first, last)]
+        path = os.path.join(self.work_dir, export_id + ".zip")
+        with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as archive:
+            for export_type in sorted(EXPORT_TYPES):
+                csv_path = os.path.join(self.work_dir, export_type + ".csv")
+                with open(csv_path, 'w') as csv_file:
+                    csv_file.write(",".join(name for (name, column_type) in EXPORT_TYPES[export_type]) + "\n")
+                    for agent in agents:
+                        write_rows(csv_file, export_type, int(agent[len("o-"):], 16), self.num_agents, samples)
+                archive.write(csv_path, str.format("{}_{}.csv", ACCOUNT_NUMBER, export_type))
+                os.remove(csv_path)
+            results = {'ExportSummary': {'ActualStartTime': start.strftime('%Y-%m-%d %H:%M:%S'), 'ActualEndTime': actual_end.strftime('%Y-%m-%d %H:%M:%S')},
+                       'RequestedStartTime': start.strftime('%Y-%m-%d %H:%M:%S'), 'RequestedEndTime': end.strftime('%Y-%m-%d %H:%M:%S')}
+            archive.writestr(str.format("{}_results.json", ACCOUNT_NUMBER), json.dumps(results))
+        self.stats['archives'] += 1
+        self.stats['archive_bytes'] += os.path.getsize(path)
+        self.stats['archive_rows'] += len(samples) * len(agents) * len(EXPORT_TYPES)
+        self.stats['generate_seconds'] += time.time() - started
+        return "file://" + os.path.abspath(path)
+
+# Returns the pids of the live processes this process started, like Spark's JVM or the arrow engine's pool workers
+def get_child_pids():
+    pids = []
+    if os.path.isdir("/proc"):
+        for pid in os.listdir("/proc"):
+            try:
+                with open(os.path.join("/proc", pid, "stat")) as stat:
+                    if int(stat.read().rsplit(")", 1)[1].split()[1]) == os.getpid():
+                        pids.append(pid)
+            except (IOError, OSError, ValueError, IndexError):
+                pass
+    return pids
+
+# Returns the sum in kB of a memory field of /proc/<pid>/status, e.g. VmHWM or VmRSS, over the given pids
+def get_status_kb(pids, field):
+    total_kb = 0
+    for pid in pids:
+        try:
+            with open(os.path.join("/proc", str(pid), "status")) as status:
+                for line in status:
+                    if line.startswith(field + ":"):
+                        total_kb += int(line.split()[1])
+        except (IOError, OSError, ValueError, IndexError):
+            pass
+    return total_kb
+
+# Returns the peak resident memory in MB of this process plus the live processes it started, like Spark's JVM
+def get_peak_rss():
+    peak_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        peak_kb /= 1024 # reported in bytes on macOS
+    return (peak_kb + get_status_kb(get_child_pids(), "VmHWM")) / 1024.0
+
+# Returns the peak resident memory in MB of the largest process this process started and waited for, like a worker
+# of the arrow engine's pool
+def get_peak_child_rss():
+    peak_kb = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    if sys.platform == "darwin":
+        peak_kb /= 1024 # reported in bytes on macOS
+    return peak_kb / 1024.0
+
+# Adds up the resident memory of this process and the processes it started every RSS_SAMPLE_SECONDS until stopped is
+# set, keeping the peak in MB in peak['mb']. Unlike get_peak_rss, this counts pool workers that have exited by the end.
+def sample_rss(stopped, peak):
+    while True:
+        peak['mb'] = max(peak['mb'], get_status_kb([os.getpid()] + get_child_pids(), "VmRSS") / 1024.0)
+        if stopped.wait(RSS_SAMPLE_SECONDS):
+            return
+
+# Converts the agentExports directory in dir_path with the given engine, number of workers and layout in this process,
+# uploading to a FakeS3 in s3_dir (a temporary directory by default). Returns the measurements.
+def run_convert(dir_path, engine, workers=1, s3_dir=None, layout="agent"):
+    peak = {'mb': 0.0}
+    stopped = threading.Event()
+    sampler = threading.Thread(target=sample_rss, args=(stopped, peak))
+    sampler.daemon = True
+    sampler.start()
+    started = time.time()
+    if engine == "spark":
+        (convert_csv.sc, convert_csv.sqlContext) = convert_csv.start_spark(workers)
+    startup = time.time() - started
+    convert_csv.engine = engine
+    convert_csv.workers = workers
+    convert_csv.layout = layout
+    convert_csv.filters = None
+    convert_csv.target_dir = os.path.join(dir_path, "parquetExports")
+    convert_csv.bucket_name = "benchmark"
+    convert_csv.s3 = FakeS3(s3_dir or tempfile.mkdtemp(prefix="discovery-benchmark-s3-"))
+    try:
+        convert_csv.get_parquet_files(dir_path)
+    finally:
+        stopped.set()
+        sampler.join()
+    result = {'engine': engine, 'workers': workers, 'startup_seconds': round(startup, 3), 'convert_seconds': round(time.time() - started - startup, 3),
+              'peak_rss_mb': round(max(get_peak_rss(), peak['mb']), 1), 'worker_peak_rss_mb': round(get_peak_child_rss(), 1)}
+    result.update(convert_csv.upload_stats)
+    if s3_dir is None:
+        shutil.rmtree(convert_csv.s3.root)
+    return result
+
+# Runs this script with the given arguments in a fresh interpreter. Returns the measurements it printed last, with the
+# wall time of the whole process, or the error it failed with.
+def run_once(arguments):
+    started = time.time()
+    process = subprocess.Popen([sys.executable, os.path.abspath(__file__)] + arguments,
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    (out, err) = process.communicate()
+    if process.returncode != 0:
+        return {'error': err.strip().splitlines()[-1] if err.strip() else "exit code " + str(process.returncode)}
+    result = json.loads(out.strip().splitlines()[-1])
+    result['wall_seconds'] = round(time.time() - started, 3)
+    return result
+
+# Runs run_convert for an engine in a fresh interpreter, so startup and memory of the engines are measured apart
+def measure_convert(dir_path, engine, workers, s3_dir, layout="agent"):
+    result = run_once(["convert-once", "--directory", dir_path, "--engine", engine, "--workers", str(workers), "--s3-dir", s3_dir, "--layout", layout])
+    result.setdefault('engine', engine)
+    return result
+
+# Returns the total size in bytes of the files under dir_path
+def get_dir_size(dir_path):
+    return sum(os.path.getsize(os.path.join(root, name)) for (root, dirs, names) in os.walk(dir_path) for name in names)
+
+# Runs export.py in this process against discovery, exporting all of its agents into dir_path like a run of export.py
+# would, with export.py's waits between status checks and after being turned away multiplied by time_scale.
+# Returns the measurements. Writing the archives is left out of export_seconds, since the service does it.
+def run_export(dir_path, discovery, download_workers=export.DOWNLOAD_WORKERS, batch_size=1, time_scale=1.0):
+    export.POLL_INTERVAL *= time_scale
+    export.YOUNG_POLL_INTERVAL *= time_scale
+    export.THROTTLE_WAIT *= time_scale
+    export.client = discovery
+    started = time.time()
+    export.agents_queue = export.describe_agents(None)
+    if batch_size > 1:
+        export.agents_queue = export.batch_agents(export.agents_queue, batch_size)
+    export.total_exports = len(export.agents_queue)
+    with open(os.path.join(dir_path, export.JOURNAL_FILE), 'a') as journal:
+        export.journal = journal
+        export.record("run", startTime=None, endTime=None, filters=None, incremental=False, agents=export.agents_queue)
+        export.run_exports(dir_path, download_workers)
+    export.journal = None
+    seconds = time.time() - started
+    result = {'export_seconds': round(seconds - discovery.stats['generate_seconds'], 3), 'export_tasks': len(discovery.tasks),
+              'api_calls': sum(discovery.stats[operation + '_calls'] for operation in ["describe_agents", "start_export_task", "describe_export_tasks"]),
+              'throttle_waits': discovery.stats['concurrency_rejections'], 'hold_off_seconds': round(export.poll_stats['hold_off_seconds'], 3),
+              'throttle_delay_seconds': round(export.poll_stats['throttle_delay_seconds'], 3),
+              'poll_ticks': export.poll_stats['ticks'], 'extracted_bytes': get_dir_size(os.path.join(dir_path, "agentExports")), 'peak_rss_mb': round(get_peak_rss(), 1)}
+    result.update(discovery.stats)
+    result['generate_seconds'] = round(result['generate_seconds'], 3)
+    return result
+
+# Options of the pipeline command passed on to export-once
+EXPORT_OPTIONS = ["agents", "days", "rows_per_day", "call_latency", "task_seconds", "max_exports", "calls_per_second", "max_export_rows",
+                  "download_workers", "batch_size", "time_scale"]
+
+# Exports a generated fleet from a FakeDiscovery with export.py, then converts the exported files with convert_csv.py
+# into a FakeS3, each stage in a fresh interpreter. Prints one JSON line per stage, with the options of the run.
+def benchmark_pipeline(args):
+    work_dir = tempfile.mkdtemp(prefix="discovery-benchmark-")
+    try:
+        options = dict((name, getattr(args, name)) for name in EXPORT_OPTIONS)
+        arguments = ["export-once", "--directory", work_dir]
+        for name in EXPORT_OPTIONS:
+            arguments += ["--" + name.replace("_", "-"), str(options[name])]
+        result = run_once(arguments)
+        result.update(options)
+        result['stage'] = "export"
+        print(json.dumps(result, sort_keys=True))
+        if 'error' in result:
+            return
+        dir_path = os.path.join(work_dir, "agentExports")
+        csv_bytes = get_dir_size(dir_path)
+        result = measure_convert(dir_path, args.engine, args.workers, tempfile.mkdtemp(prefix="s3-", dir=work_dir))
+        result.update(options)
+        result.update({'stage': "convert", 'csv_bytes': csv_bytes})
+        print(json.dumps(result, sort_keys=True))
+    finally:
+        shutil.rmtree(work_dir)
+
+def benchmark_convert(args):
+    work_dir = tempfile.mkdtemp(prefix="discovery-benchmark-")
+    try:
+        for (engine, workers) in [(engine, workers) for engine in args.engines for workers in args.workers]:
+            fleet_dir = tempfile.mkdtemp(prefix="fleet-", dir=work_dir)
+            dir_path = generate_fleet(fleet_dir, args.agents, args.files, args.rows)
+            # Later runs add --new-files files per agent and export type and convert again into the same parquetExports
+            # and fake bucket, showing what a nightly re-run costs
+            s3_dir = tempfile.mkdtemp(prefix="s3-", dir=work_dir)
+            for run in range(1, args.runs + 1):
+                if run > 1:
+                    generate_fleet(fleet_dir, args.agents, args.new_files, args.rows, first_file=args.files + (run - 2) * args.new_files)
+                result = measure_convert(dir_path, engine, workers, s3_dir)
+                result.update({'agents': args.agents, 'files': args.files, 'rows': args.rows, 'run': run, 'new_files': args.new_files if run > 1 else args.files})
+                print(json.dumps(result, sort_keys=True))
+    finally:
+        shutil.rmtree(work_dir)
+
+# Converts a generated fleet with both parquet layouts, then times each of QUERIES with query.py against the CSV files
+# and both layouts. Queries are timed from opening the connection, so listing the files counts. Each query also runs
+# with its agentId or time range passed to query.connect, which skips files that cannot match before reading them.
+def benchmark_query(args):
+    work_dir = tempfile.mkdtemp(prefix="discovery-benchmark-")
+    try:
+        dir_path = generate_fleet(work_dir, args.agents, args.files, args.rows)
+        s3_dir = tempfile.mkdtemp(prefix="s3-", dir=work_dir)
+        for layout in ["agent", "partitioned"]:
+            result = measure_convert(dir_path, "arrow", 1, s3_dir, layout)
+            result.update({'agents': args.agents, 'files': args.files, 'rows': args.rows, 'layout': layout})
+            print(json.dumps(result, sort_keys=True))
+        agent = get_agent_id(args.agents // 2)
+        start = FLEET_START + datetime.timedelta(days=3 * (args.files // 2))
+        end = start + datetime.timedelta(days=1)
+        options = {"agent": {'agents': [agent]}, "time-range": {'start': start, 'end': end}, "port": {}}
+        with open(os.devnull, 'w') as devnull:
+            for (source, name) in [(source, name) for source in query.SOURCES for name in sorted(QUERIES)]:
+                sql = QUERIES[name].format(agent=agent, start=start, end=end)
+                for pruned in [False, True] if options[name] else [False]:
+                    started = time.time()
+                    connection = query.connect(dir_path, source, **(options[name] if pruned else {}))
+                    rows = query.write_result(connection, sql, devnull)
+                    connection.close()
+                    result = {'source': source, 'query': name, 'pruned': pruned, 'result_rows': rows, 'seconds': round(time.time() - started, 3),
+                              'agents': args.agents, 'files': args.files, 'rows': args.rows}
+                    print(json.dumps(result, sort_keys=True))
+    finally:
+        shutil.rmtree(work_dir)
+
+# Builds the network graph of a generated fleet, then adds one more export window to it, and times lookups of the
+# neighbors of each agent and of the edges on a port. For comparison, also times finding the destinations of one
+# agent by scanning its connection CSV files with query.py, when DuckDB is installed.
+def benchmark_graph(args):
+    work_dir = tempfile.mkdtemp(prefix="discovery-benchmark-")
+    try:
+        dir_path = generate_fleet(work_dir, args.agents, args.files, args.rows, network_graph.GRAPH_TYPES)
+        result = {'agents': args.agents, 'files': args.files, 'rows': args.rows}
+        started = time.time()
+        network_graph.build_graph(dir_path)
+        result['build_seconds'] = round(time.time() - started, 3)
+        generate_fleet(work_dir, args.agents, 1, args.rows, network_graph.GRAPH_TYPES, first_file=args.files)
+        started = time.time()
+        network_graph.build_graph(dir_path)
+        result['incremental_build_seconds'] = round(time.time() - started, 3)
+        started = time.time()
+        graph = network_graph.load_graph(dir_path)
+        result['load_seconds'] = round(time.time() - started, 3)
+        result['edges'] = graph.edges.num_rows
+        started = time.time()
+        for n in range(args.agents):
+            graph.neighbors(get_agent_id(n))
+        result['neighbors_ms'] = round((time.time() - started) * 1000 / args.agents, 3)
+        started = time.time()
+        graph.edges_on_port(FLEET_PORTS[0])
+        result['port_ms'] = round((time.time() - started) * 1000, 3)
+        if query.duckdb is not None:
+            started = time.time()
+            connection = query.connect(dir_path, "csv")
+            connection.execute(str.format("SELECT DISTINCT destination_ip FROM source_process_connection WHERE agent_id = '{}'", get_agent_id(0))).fetchall()
+            result['rescan_ms'] = round((time.time() - started) * 1000, 3)
+        result['peak_rss_mb'] = round(get_peak_rss(), 1)
+        print(json.dumps(result, sort_keys=True))
+    finally:
+        shutil.rmtree(work_dir)
+
+# Rolls up the systemPerformance files of a generated fleet, then adds one more export window to the rollups, and
+# reports the time, rows per second and peak memory of both
+def benchmark_rollups(args):
+    work_dir = tempfile.mkdtemp(prefix="discovery-benchmark-")
+    try:
+        dir_path = generate_fleet(work_dir, args.agents, args.files, args.rows, ["systemPerformance"])
+        result = {'agents': args.agents, 'files': args.files, 'rows': args.rows}
+        started = time.time()
+        performance_rollups.build_rollups(dir_path)
+        result['build_seconds'] = round(time.time() - started, 3)
+        result['build_rows_per_second'] = int(args.agents * args.files * args.rows / (time.time() - started))
+        generate_fleet(work_dir, args.agents, 1, args.rows, ["systemPerformance"], first_file=args.files)
+        started = time.time()
+        performance_rollups.build_rollups(dir_path)
+        result['incremental_build_seconds'] = round(time.time() - started, 3)
+        result['peak_rss_mb'] = round(get_peak_rss(), 1)
+        print(json.dumps(result, sort_keys=True))
+    finally:
+        shutil.rmtree(work_dir)
+
+# Returns a dataframe reading the export files with one unionAll per file, the way convert_csv.py used to
+def load_dataframe_union(export_files, export_type):
+    df = convert_csv.sqlContext.createDataFrame(convert_csv.sc.emptyRDD(), convert_csv.get_spark_schema(export_type))
+    for export_file in export_files:
+        df = df.unionAll(convert_csv.sqlContext.read.format('com.databricks.spark.csv').options(header='true').schema(convert_csv.get_spark_schema(export_type)).load(export_file))
+    return df
+
+# Ways of reading an agent's CSV files compared by benchmark_files
+SPARK_LOADERS = {"union": load_dataframe_union, "single-read": convert_csv.load_dataframe}
+
+# Measures how planning and conversion time of one agent's export type grow with its number of CSV files
+def benchmark_files(args):
+    if any(method in SPARK_LOADERS for method in args.methods):
+        (convert_csv.sc, convert_csv.sqlContext) = convert_csv.start_spark()
+    for count in args.counts:
+        work_dir = tempfile.mkdtemp(prefix="discovery-benchmark-")
+        try:
+            type_dir = os.path.join(generate_fleet(work_dir, 1, count, args.rows, [args.export_type]), get_agent_id(0), args.export_type)
+            export_files = [os.path.join(type_dir, export) for export in sorted(os.listdir(type_dir))]
+            for method in args.methods:
+                parquet_dir = os.path.join(work_dir, method)
+                started = time.time()
+                if method == "arrow":
+                    plan = 0
+                    convert_csv.write_parquet_arrow(export_files, args.export_type, os.path.join(parquet_dir, "part-0.parquet"))
+                else:
+                    df = SPARK_LOADERS[method](export_files, args.export_type)
+                    df._jdf.queryExecution().executedPlan()
+                    plan = time.time() - started
+                    df.coalesce(1).write.parquet(parquet_dir)
+                result = {'method': method, 'files': count, 'rows': args.rows, 'export_type': args.export_type,
+                          'plan_seconds': round(plan, 3), 'convert_seconds': round(time.time() - started - plan, 3)}
+                print(json.dumps(result, sort_keys=True))
+        finally:
+            shutil.rmtree(work_dir)
+
+# Adds the options of the fake Discovery service and of export.py to the parser of the pipeline or export-once command
+def add_export_arguments(parser):
+    parser.add_argument("--agents", help="Number of agents to generate. Default is 20.", type=int, default=20)
+    parser.add_argument("--days", help="Number of days the agents reported for. Default is 30.", type=int, default=30)
+    parser.add_argument("--rows-per-day", help="Rows of each export type per agent and day. Default is 96, a sample every 15 minutes.",
+                        type=int, default=96, dest="rows_per_day")
+    parser.add_argument("--call-latency", help="Seconds each call to the fake service takes. Default is 0.05.", type=float, default=0.05, dest="call_latency")
+    parser.add_argument("--task-seconds", help="Seconds an export task runs before it succeeds. Default is 1.", type=float, default=1.0, dest="task_seconds")
+    parser.add_argument("--max-exports", help="Number of concurrent export tasks the fake service allows. Default is " + str(export.MAX_EXPORTS) + ".",
+                        type=int, default=export.MAX_EXPORTS, dest="max_exports")
+    parser.add_argument("--calls-per-second", help="describe_export_tasks calls per second after which the fake service throttles. Default is 0, no throttling.",
+                        type=int, default=0, dest="calls_per_second")
+    parser.add_argument("--max-export-rows", help="Rows of an export type per agent after which the fake service ends an export early. Default is 0, no limit.",
+                        type=int, default=0, dest="max_export_rows")
+    parser.add_argument("--download-workers", help="Number of threads of export.py downloading and extracting finished exports. Default is " + str(export.DOWNLOAD_WORKERS) + ".",
+                        type=int, default=export.DOWNLOAD_WORKERS, dest="download_workers")
+    parser.add_argument("--batch-size", help="Number of agents exported together by one export task. Default is 1.", type=int, default=1, dest="batch_size")
+    parser.add_argument("--time-scale", help="Factor applied to export.py's waits between status checks and after the concurrent export limit is hit. Default is 0.05.",
+                        type=float, default=0.05, dest="time_scale")
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmarks the discovery utilities on generated data. Results are printed as one JSON object per line.")
+    subparsers = parser.add_subparsers(dest="command")
+    convert_parser = subparsers.add_parser("convert", help="Compare the convert_csv.py engines on a generated agentExports directory.")
+    convert_parser.add_argument("--agents", help="Number of agents to generate. Default is 20.", type=int, default=20)
+    convert_parser.add_argument("--files", help="Number of CSV files per agent and export type. Default is 10.", type=int, default=10)
+    convert_parser.add_argument("--rows", help="Number of rows per CSV file. Default is 1000.", type=int, default=1000)
+    convert_parser.add_argument("--engines", help="Engines to compare. Default is all of them.", nargs='+', choices=sorted(convert_csv.ENGINES),
+                                default=sorted(convert_csv.ENGINES))
+    convert_parser.add_argument("--workers", help="Numbers of conversion workers to compare. Default is 1.", nargs='+', type=int, default=[1])
+    convert_parser.add_argument("--runs", help="Number of times to convert with each engine and number of workers, into the same parquetExports and fake bucket. "
+                                "Default is 1.", type=int, default=1)
+    convert_parser.add_argument("--new-files", help="Number of CSV files per agent and export type added before each run after the first. Default is 1.",
+                                type=int, default=1, dest="new_files")
+    files_parser = subparsers.add_parser("files", help="Measure planning and conversion time of one agent as its number of CSV files grows.")
+    files_parser.add_argument("--counts", help="Numbers of CSV files to measure. Default is 10 40 160.", nargs='+', type=int, default=[10, 40, 160])
+    files_parser.add_argument("--rows", help="Number of rows per CSV file. Default is 100.", type=int, default=100)
+    files_parser.add_argument("--export-type", help="Export type of the generated files. Default is systemPerformance.", choices=sorted(EXPORT_TYPES),
+                              default="systemPerformance", dest="export_type")
+    files_parser.add_argument("--methods", help="Ways of reading the files to compare: union (one unionAll per file, as convert_csv.py used to), "
+                              "single-read (all files in one read) and arrow. Default is all of them.", nargs='+',
+                              choices=sorted(SPARK_LOADERS) + ["arrow"], default=sorted(SPARK_LOADERS) + ["arrow"])
+    query_parser = subparsers.add_parser("query", help="Time local queries with query.py against the CSV files and both parquet layouts of a generated fleet.")
+    query_parser.add_argument("--agents", help="Number of agents to generate. Default is 100.", type=int, default=100)
+    query_parser.add_argument("--files", help="Number of CSV files per agent and export type. Default is 10.", type=int, default=10)
+    query_parser.add_argument("--rows", help="Number of rows per CSV file. Default is 1000.", type=int, default=1000)
+    graph_parser = subparsers.add_parser("graph", help="Time building, updating and looking up the network graph of a generated fleet.")
+    graph_parser.add_argument("--agents", help="Number of agents to generate. Default is 100.", type=int, default=100)
+    graph_parser.add_argument("--files", help="Number of CSV files per agent and export type. Default is 10.", type=int, default=10)
+    graph_parser.add_argument("--rows", help="Number of rows per CSV file. Default is 1000.", type=int, default=1000)
+    rollups_parser = subparsers.add_parser("rollups", help="Time building and updating the systemPerformance rollups of a generated fleet.")
+    rollups_parser.add_argument("--agents", help="Number of agents to generate. Default is 100.", type=int, default=100)
+    rollups_parser.add_argument("--files", help="Number of CSV files per agent. Default is 10.", type=int, default=10)
+    rollups_parser.add_argument("--rows", help="Number of rows per CSV file. Default is 288, a sample every 15 minutes.", type=int, default=288)
+    pipeline_parser = subparsers.add_parser("pipeline", help="Export a generated fleet from a fake Discovery service with export.py, then convert it with convert_csv.py.")
+    add_export_arguments(pipeline_parser)
+    pipeline_parser.add_argument("--engine", help="Engine converting the exported files. Default is arrow.", choices=sorted(convert_csv.ENGINES), default="arrow")
+    pipeline_parser.add_argument("--workers", help="Number of conversion workers. Default is 1.", type=int, default=1)
+    export_once_parser = subparsers.add_parser("export-once", help="Export a generated fleet from a fake Discovery service and print the measurements.")
+    export_once_parser.add_argument("--directory", help="Path to the directory to export into.", type=str, required=True)
+    add_export_arguments(export_once_parser)
+    once_parser = subparsers.add_parser("convert-once", help="Convert an agentExports directory with one engine and print the measurements.")
+    once_parser.add_argument("--directory", help="Path to the agentExports directory.", type=str, required=True)
+    once_parser.add_argument("--engine", choices=sorted(convert_csv.ENGINES), required=True)
+    once_parser.add_argument("--workers", type=int, default=1)
+    once_parser.add_argument("--layout", choices=["agent", "partitioned"], default="agent")
+    once_parser.add_argument("--s3-dir", help="Directory of the fake S3 bucket to upload to. Default is a temporary directory.", dest="s3_dir")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    if args.command == "convert":
+        benchmark_convert(args)
+    elif args.command == "files":
+        benchmark_files(args)
+    elif args.command == "query":
+        benchmark_query(args)
+    elif args.command == "graph":
+        benchmark_graph(args)
+    elif args.command == "rollups":
+        benchmark_rollups(args)
+    elif args.command == "pipeline":
+        benchmark_pipeline(args)
+    elif args.command == "export-once":
+        discovery = FakeDiscovery(tempfile.mkdtemp(prefix="discovery-benchmark-archives-"), args.agents, args.days, args.rows_per_day, args.call_latency,
+                                  args.task_seconds, args.max_exports, args.calls_per_second, args.max_export_rows)
+        try:
+            result = run_export(args.directory, discovery, args.download_workers, args.batch_size, args.time_scale)
+        finally:
+            shutil.rmtree(discovery.work_dir)
+        print(json.dumps(result, sort_keys=True))
+    elif args.command == "convert-once":
+        result = run_convert(args.directory, args.engine, args.workers, args.s3_dir, args.layout)
+        print(json.dumps(result, sort_keys=True))
@@ -2,89 +2,181 @@ import os
 import sys
 import argparse
 import shutil
-from pyspark import SparkContext
-from pyspark import SparkConf
-from pyspark.sql import SQLContext
-from pyspark.sql.types import *
 import time
 import csv
 import datetime
-import boto3
 import glob
+import hashlib
+import json
 import re
+import threading
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+try:
+    from Queue import Queue
+except ImportError: # Python 3
+    from queue import Queue
+try:
+    import boto3
+    from boto3.s3.transfer import TransferConfig
+except ImportError: # only needed to upload to S3
+    boto3 = None
+try:
+    from pyspark import SparkContext
+    from pyspark import SparkConf
+    from pyspark.sql import SQLContext
+    from pyspark.sql.types import *
+except ImportError: # only needed for --engine spark
+    SparkContext = None
+try:
+    import pyarrow
+    import pyarrow.csv
+    import pyarrow.compute
+    import pyarrow.parquet
+except ImportError: # only needed for --engine arrow
+    pyarrow = None
 
 # Network interface schema
-NETWORK_SCHEMA = StructType([
-    StructField("account_number", LongType(), True),
-    StructField("agent_id", StringType(), True),
-    StructField("name", StringType(), True),
-    StructField("mac_address", StringType(), True),
-    StructField("family", StringType(), True),
-    StructField("ip_address", StringType(), True),
-    StructField("gateway", StringType(), True),
-    StructField("net_mask", StringType(), True),
-    StructField("timestamp", TimestampType(), True)])
+NETWORK_SCHEMA = [
+    ("account_number", "bigint"),
+    ("agent_id", "string"),
+    ("name", "string"),
+    ("mac_address", "string"),
+    ("family", "string"),
+    ("ip_address", "string"),
+    ("gateway", "string"),
+    ("net_mask", "string"),
+    ("timestamp", "timestamp")]
 
 # Process Connection schema (for both source/destination)
-PC_SCHEMA = StructType([
-    StructField("account_number", LongType(), True),
-    StructField("agent_id", StringType(), True),
-    StructField("source_ip", StringType(), True),
-    StructField("source_port", IntegerType(), True),
-    StructField("destination_ip", StringType(), True),
-    StructField("destination_port", IntegerType(), True),
-    StructField("ip_version", StringType(), True),
-    StructField("transport_protocol", StringType(), True),
-    StructField("agent_assigned_process_id", StringType(), True),
-    StructField("agent_creation_date", TimestampType(), True)])
+PC_SCHEMA = [
+    ("account_number", "bigint"),
+    ("agent_id", "string"),
+    ("source_ip", "string"),
+    ("source_port", "int"),
+    ("destination_ip", "string"),
+    ("destination_port", "int"),
+    ("ip_version", "string"),
+    ("transport_protocol", "string"),
+    ("agent_assigned_process_id", "string"),
+    ("agent_creation_date", "timestamp")]
 
 # OS Info schema
-OS_SCHEMA = StructType([
-    StructField("account_number", LongType(), True),
-    StructField("agent_id", StringType(), True),
-    StructField("os_name", StringType(), True),
-    StructField("os_version", StringType(), True),
-    StructField("cpu_type", StringType(), True),
-    StructField("host_name", StringType(), True),
-    StructField("hypervisor", StringType(), True),
-    StructField("timestamp", TimestampType(), True)])
-
-PROCESS_SCHEMA = StructType([
-    StructField("account_number", LongType(), True),
-    StructField("agent_id", StringType(), True),
-    StructField("agent_assigned_process_id", StringType(), True),
-    StructField("is_system", BooleanType(), True),
-    StructField("name", StringType(), True),
-    StructField("cmd_line", StringType(), True),
-    StructField("path", StringType(), True),
-    StructField("agent_provided_timestamp", TimestampType(), True)])
+OS_SCHEMA = [
+    ("account_number", "bigint"),
+    ("agent_id", "string"),
+    ("os_name", "string"),
+    ("os_version", "string"),
+    ("cpu_type", "string"),
+    ("host_name", "string"),
+    ("hypervisor", "string"),
+    ("timestamp", "timestamp")]
+
+PROCESS_SCHEMA = [
+    ("account_number", "bigint"),
+    ("agent_id", "string"),
+    ("agent_assigned_process_id", "string"),
+    ("is_system", "boolean"),
+    ("name", "string"),
+    ("cmd_line", "string"),
+    ("path", "string"),
+    ("agent_provided_timestamp", "timestamp")]
 
 # System performance schema
-PERF_SCHEMA = StructType([
-    StructField("account_number", LongType(), True),
-    StructField("agent_id", StringType(), True),
-    StructField("total_disk_bytes_read_per_sec_in_kbps", DoubleType(), True),
-    StructField("total_disk_bytes_written_per_sec_in_kbps", DoubleType(), True),
-    StructField("total_disk_read_ops_per_sec", DoubleType(), True),
-    StructField("total_disk_write_ops_per_sec", DoubleType(), True),
-    StructField("total_network_bytes_read_per_sec_in_kbps", DoubleType(), True),
-    StructField("total_network_bytes_written_per_sec_in_kbps", DoubleType(), True),
-    StructField("total_num_logical_processors", IntegerType(), True),
-    StructField("total_num_cores", IntegerType(), True),
-    StructField("total_num_cpus", IntegerType(), True),
-    StructField("total_num_disks", IntegerType(), True),
-    StructField("total_num_network_cards", IntegerType(), True),
-    StructField("total_cpu_usage_pct", DoubleType(), True),
-    StructField("total_disk_size_in_gb", DoubleType(), True),
-    StructField("total_disk_free_size_in_gb", DoubleType(), True),
-    StructField("total_ram_in_mb", DoubleType(), True),
-    StructField("total_free_ram_in_mb", DoubleType(), True),
-    StructField("timestamp", TimestampType(), True)])
-
-# Maps export types to their schema for pyspark
+PERF_SCHEMA = [
+    ("account_number", "bigint"),
+    ("agent_id", "string"),
+    ("total_disk_bytes_read_per_sec_in_kbps", "double"),
+    ("total_disk_bytes_written_per_sec_in_kbps", "double"),
+    ("total_disk_read_ops_per_sec", "double"),
+    ("total_disk_write_ops_per_sec", "double"),
+    ("total_network_bytes_read_per_sec_in_kbps", "double"),
+    ("total_network_bytes_written_per_sec_in_kbps", "double"),
+    ("total_num_logical_processors", "int"),
+    ("total_num_cores", "int"),
+    ("total_num_cpus", "int"),
+    ("total_num_disks", "int"),
+    ("total_num_network_cards", "int"),
+    ("total_cpu_usage_pct", "double"),
+    ("total_disk_size_in_gb", "double"),
+    ("total_disk_free_size_in_gb", "double"),
+    ("total_ram_in_mb", "double"),
+    ("total_free_ram_in_mb", "double"),
+    ("timestamp", "timestamp")]
+
+# Maps export types to their columns, as (name, Athena type) in the order of the CSV files
 EXPORT_TYPES = {"destinationProcessConnection" : PC_SCHEMA, "networkInterface": NETWORK_SCHEMA, "osInfo": OS_SCHEMA,
                 "process": PROCESS_SCHEMA, "sourceProcessConnection": PC_SCHEMA, "systemPerformance": PERF_SCHEMA}
 
+WORKER_MEMORY = 1024 # Default MB of memory for each conversion worker
+ARROW_MEMORY_FACTOR = 32 # A worker of the arrow engine reads record batches of 1/ARROW_MEMORY_FACTOR of its memory
+UPLOAD_QUEUE_SIZE = 16 # Max number of converted parquet files waiting to be uploaded before conversion pauses
+UPLOAD_THREADS = 4 # Default number of threads uploading parquet files to S3
+MULTIPART_SIZE = 32 * 1024 * 1024 # Files larger than this are uploaded in parts of this size
+MULTIPART_CONCURRENCY = 4 # Number of parts of a file uploaded at once
+MD5_METADATA = "content-md5" # S3 object metadata holding the MD5 digest of the uploaded file
+PARTITIONED_PREFIX = "partitioned" # Directory and S3 prefix of the partitioned layout
+PARTITIONED_DDL_FILE = "discovery_athena_partitioned.ddl"
+TARGET_FILE_SIZE = 128 # Default MB at which the partitioned layout starts a new parquet file
+ROW_GROUP_ROWS = 128 * 1024 # Rows buffered into each row group of the partitioned layout
+MANIFEST_FILE = "conversionManifest.jsonl" # Records in parquetExports which CSV files each uploaded parquet file covers
+
+engine = "spark"
+layout = "agent"
+target_file_size = TARGET_FILE_SIZE * 1024 * 1024
+upload_threads = UPLOAD_THREADS
+transfer_config = None # TransferConfig of the uploads, set in __main__
+# Files and bytes uploaded, and skipped because S3 already had the same content, updated by all upload threads
+upload_stats = {'files_sent': 0, 'bytes_sent': 0, 'files_skipped': 0, 'bytes_skipped': 0}
+upload_stats_lock = threading.Lock()
+manifest = None # Open manifest file of target_dir, appended to by the upload threads under manifest_lock
+manifest_lock = threading.Lock()
+workers = 1
+arrow_block_size = WORKER_MEMORY * 1024 * 1024 // ARROW_MEMORY_FACTOR # Bytes of CSV read into each record batch by the arrow engine
+
+# Maps the column types used in EXPORT_TYPES to Arrow types
+def get_arrow_type(column_type):
+    if column_type == "bigint":
+        return pyarrow.int64()
+    if column_type == "int":
+        return pyarrow.int32()
+    if column_type == "double":
+        return pyarrow.float64()
+    if column_type == "boolean":
+        return pyarrow.bool_()
+    if column_type == "timestamp":
+        return pyarrow.timestamp('ms')
+    return pyarrow.string()
+
+# Returns the Arrow schema of an export type
+def get_arrow_schema(export_type):
+    return pyarrow.schema([pyarrow.field(name, get_arrow_type(column_type), True) for (name, column_type) in EXPORT_TYPES[export_type]])
+
+# Maps the column types used in EXPORT_TYPES to pyspark types
+def get_spark_type(column_type):
+    if column_type == "bigint":
+        return LongType()
+    if column_type == "int":
+        return IntegerType()
+    if column_type == "double":
+        return DoubleType()
+    if column_type == "boolean":
+        return BooleanType()
+    if column_type == "timestamp":
+        return TimestampType()
+    return StringType()
+
+# Returns the pyspark schema of an export type
+def get_spark_schema(export_type):
+    return StructType([StructField(name, get_spark_type(column_type), True) for (name, column_type) in EXPORT_TYPES[export_type]])
+
+# Returns the rows of an exported CSV file as an Arrow table, matching columns to the schema by position
+def read_export_file(export_file, export_type):
+    schema = get_arrow_schema(export_type)
+    read_options = pyarrow.csv.ReadOptions(column_names=schema.names, skip_rows=1)
+    convert_options = pyarrow.csv.ConvertOptions(column_types=dict(zip(schema.names, schema.types)), strings_can_be_null=True)
+    return pyarrow.csv.read_csv(export_file, read_options=read_options, convert_options=convert_options)
+
 def get_subdirs(directory):
     return [name for name in os.listdir(directory) if os.path.isdir(os.path.join(directory, name))]
 
@@ -96,67 +188,438 @@ def get_dataframe(filename, export_type):
     header = text_file.first()
     headerless_file = text_file.filter(lambda x: x != header)
     rdd = headerless_file.map(lambda line: parse_line(line, export_type))
-    return sqlContext.createDataFrame(rdd, EXPORT_TYPES[export_type])
+    return sqlContext.createDataFrame(rdd, get_spark_schema(export_type))
 
 def is_agent_id(maybe_agent_id):
     return re.match("[io]-[0-9a-z]{17}$", maybe_agent_id)
 
+# Returns a pyspark dataframe reading all given CSV files of an export type. The files are passed to a single read,
+# so the plan stays the same size however many files an agent has.
+def load_dataframe(export_files, export_type):
+    if len(export_files) == 0:
+        return sqlContext.createDataFrame(sc.emptyRDD(), get_spark_schema(export_type))
+    return sqlContext.read.format('com.databricks.spark.csv').options(header='true').schema(get_spark_schema(export_type)).load(export_files)
+
+# Writes the CSV files of an export type into one parquet file with Spark
+def write_parquet_spark(export_files, export_type, parquet_file):
+    df = load_dataframe(export_files, export_type)
+    subfolder_dir = os.path.dirname(parquet_file)
+    if os.path.isdir(subfolder_dir):
+        shutil.rmtree(subfolder_dir) # an empty target directory is required by spark to write out the dataframe
+    #df.toPandas().to_csv(os.path.join(target_dir, export_type + ".csv"))
+    df.coalesce(1).write.parquet(subfolder_dir)
+    os.rename(glob.glob(os.path.join(subfolder_dir, "part-*"))[0], parquet_file)
+
+# Writes the CSV files of an export type into one parquet file with Arrow, without a JVM. Each CSV file is streamed
+# in record batches of arrow_block_size bytes, so memory use does not grow with the amount of data. As with Spark,
+# columns are matched to the schema by position, and timestamps are stored as INT96 like Spark does.
+def write_parquet_arrow(export_files, export_type, parquet_file):
+    schema = get_arrow_schema(export_type)
+    read_options = pyarrow.csv.ReadOptions(column_names=schema.names, skip_rows=1, block_size=arrow_block_size)
+    convert_options = pyarrow.csv.ConvertOptions(column_types=dict(zip(schema.names, schema.types)), strings_can_be_null=True)
+    subfolder_dir = os.path.dirname(parquet_file)
+    if os.path.isdir(subfolder_dir):
+        shutil.rmtree(subfolder_dir)
+    os.makedirs(subfolder_dir)
+    writer = pyarrow.parquet.ParquetWriter(parquet_file, schema, use_deprecated_int96_timestamps=True)
+    try:
+        for export_file in export_files:
+            reader = pyarrow.csv.open_csv(export_file, read_options=read_options, convert_options=convert_options)
+            for batch in reader:
+                writer.write_table(pyarrow.Table.from_batches([batch], schema))
+    finally:
+        writer.close()
+
+# Returns the name of the first timestamp column of an export type
+def get_timestamp_column(export_type):
+    return [name for (name, column_type) in EXPORT_TYPES[export_type] if column_type == "timestamp"][0]
+
+# Writes the CSV files of one dt partition of an export type into parquet files of about target_file_size bytes in
+# partition_dir, sorted by agent_id and timestamp so Athena can skip row groups by their statistics. The files come
+# agent by agent in agentId order, so sorting each of them by timestamp sorts the parquet files written while only
+# holding one file and one row group in memory. Parts are numbered from first_part, after those already in the
+# partition. Returns the parquet files written.
+def write_partition_arrow(export_files, export_type, partition_dir, first_part=0):
+    schema = get_arrow_schema(export_type)
+    read_options = pyarrow.csv.ReadOptions(column_names=schema.names, skip_rows=1, block_size=arrow_block_size)
+    convert_options = pyarrow.csv.ConvertOptions(column_types=dict(zip(schema.names, schema.types)), strings_can_be_null=True)
+    sort_keys = [(get_timestamp_column(export_type), "ascending")]
+    if not os.path.isdir(partition_dir):
+        os.makedirs(partition_dir)
+    parquet_files = []
+    writer = None
+    row_group = []
+    try:
+        for (n, export_file) in enumerate(export_files):
+            table = pyarrow.csv.read_csv(export_file, read_options=read_options, convert_options=convert_options)
+            row_group.append(table.take(pyarrow.compute.sort_indices(table, sort_keys=sort_keys)))
+            if sum(part.num_rows for part in row_group) < ROW_GROUP_ROWS and n < len(export_files) - 1:
+                continue
+            if writer is None:
+                parquet_files.append(os.path.join(partition_dir, str.format("part-{:05d}.parquet", first_part + len(parquet_files))))
+                writer = pyarrow.parquet.ParquetWriter(parquet_files[-1], schema, use_deprecated_int96_timestamps=True)
+            writer.write_table(pyarrow.concat_tables(row_group), row_group_size=ROW_GROUP_ROWS)
+            row_group = []
+            if os.path.getsize(parquet_files[-1]) >= target_file_size:
+                writer.close()
+                writer = None
+    finally:
+        if writer is not None:
+            writer.close()
+    return parquet_files
+
+# Returns the Athena table name of an export type, e.g. network_interface for networkInterface
+def get_table_name(export_type):
+    return re.sub("([A-Z])", r"_\1", export_type).lower()
+
+# Returns the Athena DDL of the tables of the partitioned layout in the given bucket, which have the same names and
+# columns as the tables in discovery_athena.ddl plus a dt partition column. MSCK REPAIR TABLE loads the partitions.
+# dt is the day an export started, not the day of each row, so the header says how queries have to filter on it.
+def get_partitioned_ddl(bucket):
+    statements = ["-- dt is the day the export holding a row started. An export covers up to 30 days, so the rows of days X to Y\n"
+                  "-- are in the partitions dt BETWEEN X - 30 days AND Y. Filter on dt with that range and on the timestamp\n"
+                  "-- column for the exact days; filtering on dt alone misses rows and returns rows of other days.\n"]
+    for export_type in sorted(EXPORT_TYPES):
+        columns = ",\n".join(str.format("  `{}` {}", name, column_type) for (name, column_type) in EXPORT_TYPES[export_type])
+        statements.append(str.format("CREATE EXTERNAL TABLE IF NOT EXISTS {} (\n{}\n)\nPARTITIONED BY (`dt` string)\n"
+                                     "ROW FORMAT SERDE 'org.apache.hadoop.hive.ql.io.parquet.serde.ParquetHiveSerDe'\n"
+                                     "WITH SERDEPROPERTIES (\n  'serialization.format' = '1'\n) LOCATION 's3://{}/{}/{}/'\n"
+                                     "TBLPROPERTIES ('has_encrypted_data'='false');\n\nMSCK REPAIR TABLE {};\n",
+                                     get_table_name(export_type), columns, bucket, PARTITIONED_PREFIX, export_type, get_table_name(export_type)))
+    return "\n".join(statements)
+
+# Conversion engines selectable with --engine
+ENGINES = {"spark": write_parquet_spark, "arrow": write_parquet_arrow}
+
+# Returns the CSV files of an agent's export type in the order of their export start times
+def get_export_files(dir_path, agent, export_type):
+    export_files = []
+    for export in sorted(os.listdir(os.path.join(dir_path, agent, export_type))):
+        # Remove colons if necessary from filename for compatibility with Spark
+        export_file = os.path.join(dir_path, agent, export_type, export)
+        if ":" in export_file:
+            new_name = export_file.replace(":", "")
+            os.rename(export_file, new_name)
+            export_file = new_name
+        # Only convert non-hidden CSV files
+        if '.csv' in export_file:
+            export_files.append(export_file)
+    return export_files
+
+# Returns the start time of an export from the name of one of its files, e.g. 2017-11-04T000100Z_<accountNumber>_<type>.csv
+def get_file_start(export_file):
+    return datetime.datetime.strptime(os.path.basename(export_file)[:18].replace(":", ""), '%Y-%m-%dT%H%M%SZ')
+
+# Returns the files of one agent, sorted by the start time of their exports, that may hold rows between start and end.
+# A file holds rows from its export's start until the next file starts at the latest, since exports do not overlap.
+def prune_by_time(export_files, start, end):
+    starts = [get_file_start(export_file) for export_file in export_files]
+    pruned = []
+    for (n, export_file) in enumerate(export_files):
+        if end is not None and starts[n] >= end:
+            continue
+        if start is not None and n < len(export_files) - 1 and starts[n + 1] <= start:
+            continue
+        pruned.append(export_file)
+    return pruned
+
+# Returns the agentIds of the agents in dir_path, or only those in agents if given
+def get_agents(dir_path, agents):
+    return sorted(agent for agent in get_subdirs(dir_path) if is_agent_id(agent) and (not agents or agent in agents))
+
+# Returns the CSV files of an export type in the agentExports directory dir_path for the given agents between start and end
+def get_csv_files(dir_path, export_type, agents, start, end):
+    export_files = []
+    for agent in get_agents(dir_path, agents):
+        type_dir = os.path.join(dir_path, agent, export_type)
+        if os.path.isdir(type_dir):
+            agent_files = [os.path.join(type_dir, name) for name in sorted(os.listdir(type_dir)) if name.endswith(".csv")]
+            export_files.extend(prune_by_time(agent_files, start, end))
+    return export_files
+
+# Returns the manifest entries of each group of parquet files in target_dir, leaving out those replaced by a later
+# rebuild of their group. A group is the agent and export type, or the dt partition of the partitioned layout.
+def load_manifest():
+    groups = {}
+    path = os.path.join(target_dir, MANIFEST_FILE)
+    if not os.path.isfile(path):
+        return groups
+    with open(path) as manifest_file:
+        for line in manifest_file:
+            try:
+                entry = json.loads(line)
+            except ValueError: # last line may have been cut short by a crash
+                continue
+            if entry['rebuild']:
+                groups[entry['group']] = []
+            groups.setdefault(entry['group'], []).append(entry)
+    return groups
+
+# Returns the [path relative to dir_path, size, mtime] recorded in the manifest for a CSV file
+def get_source(dir_path, export_file):
+    stat = os.stat(export_file)
+    return [os.path.relpath(export_file, dir_path), stat.st_size, stat.st_mtime]
+
+# Returns the manifest entry for converting those CSV files of a group that its manifest entries do not cover yet,
+# or None if they cover all of them. If a covered file has changed or is gone, the whole group is rebuilt, replacing
+# its parquet files. New parts are numbered after the group's existing ones.
+def get_conversion_entry(dir_path, group, export_files, entries):
+    sources = [get_source(dir_path, export_file) for export_file in export_files]
+    current = dict((source[0], source[1:]) for source in sources)
+    covered = dict((source[0], source[1:]) for entry in entries for source in entry['sources'])
+    rebuild = len(entries) == 0 or any(current.get(path) != stat for (path, stat) in covered.items())
+    if not rebuild:
+        sources = [source for source in sources if source[0] not in covered]
+    if len(sources) == 0:
+        return None
+    parts = [part for entry in entries for part in entry['parts']]
+    return {'group': group, 'rebuild': rebuild, 'sources': sources, 'first_part': 0 if rebuild else len(parts), 'replaced': parts if rebuild else []}
+
+# Appends a conversion whose parquet files have all been uploaded to the manifest, after deleting the S3 objects of
+# the parts it replaced that were not uploaded again. Called under manifest_lock.
+def record_conversion(entry):
+    keys = [key for (key, parquet_file) in entry['parts']]
+    for (key, parquet_file) in entry['replaced']:
+        if key not in keys:
+            s3.delete_object(Bucket=bucket_name, Key=key)
+    manifest.write(json.dumps(dict((field, entry[field]) for field in ['group', 'rebuild', 'sources', 'parts'])) + "\n")
+    manifest.flush()
+    os.fsync(manifest.fileno())
+
 def get_parquet_files(dir_path):
-    # Concatenates same csv file types as parquet files within agentsExports folder, under "parquetExports" subdir
+    # Concatenates same csv file types as parquet files within agentsExports folder, under "parquetExports" subdir.
+    # Only CSV files not yet covered by the manifest are converted, into new parquet parts next to the existing ones.
+    global manifest
     try:
         os.makedirs(target_dir)
     except OSError: # already exists
         pass
-    dfs = {}
+    manifest_entries = load_manifest()
+    manifest = open(os.path.join(target_dir, MANIFEST_FILE), 'a')
     # get directory listing we will iterate over
     if filters:
         agent_dirs = [x for x in get_subdirs(dir_path) if x in filters]
     else:
         agent_dirs = get_subdirs(dir_path)
+    agent_dirs = [agent for agent in agent_dirs if is_agent_id(agent)]
 
-    # build a single parquet file for each export type for each agent
-    for agent in agent_dirs:
-        if not is_agent_id(agent):
-            continue
-        # Initialize empty data frames to load in csv files for all export types
-        for export_type in EXPORT_TYPES:
-            empty_df = sqlContext.createDataFrame(sc.emptyRDD(), EXPORT_TYPES[export_type])
-            dfs[export_type] = empty_df
+    try:
+        if layout == "partitioned":
+            convert_all(get_partitioned_conversions(dir_path, agent_dirs, manifest_entries))
+            with open(os.path.join(target_dir, PARTITIONED_DDL_FILE), 'w') as ddl_file:
+                ddl_file.write(get_partitioned_ddl(bucket_name))
+            print(str.format("Athena tables for the partitioned layout are defined in {}", os.path.join(target_dir, PARTITIONED_DDL_FILE)))
+        else:
+            convert_all(get_agent_conversions(dir_path, agent_dirs, manifest_entries))
+    finally:
+        manifest.close()
 
+# Returns a conversion for each export type of each agent that has CSV files not yet in its parquet files. Each
+# conversion writes a new parquet file, labeled with the start time of the first of those CSV files.
+def get_agent_conversions(dir_path, agent_dirs, manifest_entries):
+    conversions = []
+    for agent in agent_dirs:
         agent_export_types = [export_type for export_type in get_subdirs(os.path.join(dir_path, agent)) if export_type != "results"]
         for export_type in agent_export_types:
-            exports = sorted(os.listdir(os.path.join(dir_path, agent, export_type)))
-            date = exports[0][:18] # export files are of the form 2017-11-04T000100Z_<accountNumber>_<type>.csv
-            print(str.format("Loading {} exported CSV files of type {} for agent {}, will be labeled with {}", len(exports), export_type, agent, date))
-            for export in exports:
-                # Remove colons if necessary from filename for compatibility with Spark
-                export_file = os.path.join(dir_path, agent, export_type, export)
-                if ":" in export_file:
-                    new_name = export_file.replace(":", "")
-                    os.rename(export_file, new_name)
-                    export_file = new_name
-                # Get dataframe for non-hidden CSV files
-                if '.csv' in export_file:
-                    df = sqlContext.read.format('com.databricks.spark.csv').options(header='true').schema(EXPORT_TYPES[export_type]).load(export_file)
-                    dfs[export_type] = dfs[export_type].unionAll(df)
-
-            # Write the dataframe for each export type to a subdirectory of the target directory
-            print(" Converting to parquet...")
+            group = export_type + "/" + agent
+            entries = manifest_entries.get(group, [])
+            entry = get_conversion_entry(dir_path, group, get_export_files(dir_path, agent, export_type), entries)
+            if entry is None:
+                print(str.format("Parquet files of type {} for agent {} are up to date", export_type, agent))
+                continue
+            if entry['rebuild']:
+                for (key, parquet_file) in entry['replaced']:
+                    shutil.rmtree(os.path.dirname(os.path.join(target_dir, parquet_file)), ignore_errors=True)
+            export_files = [os.path.join(dir_path, source[0]) for source in entry['sources']]
+            date = os.path.basename(export_files[0])[:18] # export files are of the form 2017-11-04T000100Z_<accountNumber>_<type>.csv
+            print(str.format("Loading {} {}exported CSV files of type {} for agent {}, will be labeled with {}",
+                             len(export_files), "" if entry['rebuild'] else "new ", export_type, agent, date))
+
+            # Write the export type to a parquet file in a subdirectory of the target directory
             new_name = str.format("{}_{}.parquet", date, agent)
             subfolder_dir = os.path.join(target_dir, export_type + "-" + new_name)
-            if os.path.isdir(subfolder_dir):
-                shutil.rmtree(subfolder_dir) # an empty target directory is required by spark to write out the dataframe
-            #dfs[export_type].toPandas().to_csv(os.path.join(target_dir, export_type + ".csv"))
-            dfs[export_type].coalesce(1).write.parquet(subfolder_dir)
-            parquet_file = glob.glob(os.path.join(subfolder_dir, "part-*"))[0]
-            os.rename(parquet_file, os.path.join(subfolder_dir, new_name))
+            conversions.append((export_type, export_files, os.path.join(subfolder_dir, new_name), export_type, entry))
+    return conversions
+
+# Returns a conversion for each export type and day of the partitioned layout with CSV files not yet in its parquet
+# files, taking the CSV files of all agents whose export started that day. Files are listed agent by agent in
+# agentId order, then by export start time. A partition holds every agent's files, so the partitions of the given
+# agents are compared with the manifest using the files of all agents, or the others would count as gone.
+def get_partitioned_conversions(dir_path, agent_dirs, manifest_entries):
+    conversions = []
+    all_agents = sorted(agent for agent in get_subdirs(dir_path) if is_agent_id(agent))
+    for export_type in sorted(EXPORT_TYPES):
+        partitions = {}
+        touched = set()
+        for agent in all_agents:
+            if not os.path.isdir(os.path.join(dir_path, agent, export_type)):
+                continue
+            for export_file in get_export_files(dir_path, agent, export_type):
+                partitions.setdefault(os.path.basename(export_file)[:10], []).append(export_file)
+                if agent in agent_dirs:
+                    touched.add(os.path.basename(export_file)[:10])
+        for dt in sorted(touched):
+            key_prefix = str.format("{}/{}/dt={}", PARTITIONED_PREFIX, export_type, dt)
+            partition_dir = os.path.join(target_dir, PARTITIONED_PREFIX, export_type, "dt=" + dt)
+            entry = get_conversion_entry(dir_path, key_prefix, partitions[dt], manifest_entries.get(key_prefix, []))
+            if entry is None:
+                print(str.format("Parquet files of type {} for dt={} are up to date", export_type, dt))
+                continue
+            if entry['rebuild']:
+                shutil.rmtree(partition_dir, ignore_errors=True)
+            export_files = [os.path.join(dir_path, source[0]) for source in entry['sources']]
+            print(str.format("Loading {} {}exported CSV files of type {} for dt={}",
+                             len(export_files), "" if entry['rebuild'] else "new ", export_type, dt))
+            conversions.append((export_type, export_files, partition_dir, key_prefix, entry))
+    return conversions
+
+# Sets up a process of the arrow engine's worker pool
+def init_worker(worker_engine, block_size, worker_layout, file_size):
+    global engine, arrow_block_size, layout, target_file_size
+    engine = worker_engine
+    arrow_block_size = block_size
+    layout = worker_layout
+    target_file_size = file_size
+
+# Runs a conversion of (export type, CSV files, output, S3 key prefix, manifest entry): with the partitioned layout
+# the output is a partition directory, otherwise a parquet file. Returns the manifest entry and the (S3 key, file) of
+# each parquet file written.
+def convert(conversion):
+    (export_type, export_files, output, key_prefix, entry) = conversion
+    print(str.format(" Converting {} to parquet...", output))
+    if layout == "partitioned":
+        parquet_files = write_partition_arrow(export_files, export_type, output, entry['first_part'])
+    else:
+        ENGINES[engine](export_files, export_type, output)
+        parquet_files = [output]
+    return (entry, [(key_prefix + "/" + os.path.basename(parquet_file), parquet_file) for parquet_file in parquet_files])
+
+# Returns the hex MD5 digest of a file
+def get_md5(path):
+    md5 = hashlib.md5()
+    with open(path, 'rb') as source:
+        for chunk in iter(lambda: source.read(MULTIPART_SIZE), b""):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+# Returns whether the object at key already holds content with the given MD5 digest. The digest is kept in the
+# object's metadata, since the ETag of a multipart upload is not the MD5 of its content.
+def is_uploaded(key, md5):
+    try:
+        response = s3.head_object(Bucket=bucket_name, Key=key)
+    except Exception as e:
+        if getattr(e, 'response', {}).get('Error', {}).get('Code') in ["404", "NoSuchKey", "NotFound"]:
+            return False
+        raise(e)
+    return response.get('Metadata', {}).get(MD5_METADATA) == md5 or response.get('ETag', "").strip('"') == md5
+
+# Uploads a parquet file to key, unless S3 already has the same content there, and counts it in upload_stats
+def upload_parquet(key, parquet_file):
+    size = os.path.getsize(parquet_file)
+    md5 = get_md5(parquet_file)
+    if is_uploaded(key, md5):
+        print(str.format("   {} is unchanged in S3, skipping upload", key))
+        sent = False
+    else:
+        print(str.format("   Uploading {} to S3...", key))
+        s3.upload_file(parquet_file, bucket_name, key, ExtraArgs={'Metadata': {MD5_METADATA: md5}}, Config=transfer_config)
+        print("    Successful!")
+        sent = True
+    with upload_stats_lock:
+        upload_stats['files_sent' if sent else 'files_skipped'] += 1
+        upload_stats['bytes_sent' if sent else 'bytes_skipped'] += size
+
+# Uploads the (S3 key, parquet file, manifest entry) put on uploads to S3, until it gets None. Once all files of a
+# conversion are uploaded, it is recorded in the manifest. Errors are appended to errors, but the queue keeps being
+# drained so conversion never blocks on a dead uploader.
+def upload_worker(uploads, errors):
+    while True:
+        upload = uploads.get()
+        if upload is None:
+            return
+        if len(errors) > 0:
+            continue
+        (key, parquet_file, entry) = upload
+        try:
+            upload_parquet(key, parquet_file)
+            with manifest_lock:
+                entry['pending'] -= 1
+                if entry['pending'] == 0:
+                    record_conversion(entry)
+        except Exception as e:
+            errors.append(e)
 
-            # Upload to S3
-            print("   Uploading to S3...")
-            for parquet_file in os.listdir(subfolder_dir):
-                if not parquet_file.startswith('.') and not parquet_file.startswith('_'):
-                    s3.upload_file(os.path.join(subfolder_dir, parquet_file), bucket_name, os.path.join(export_type, parquet_file))
-            print("    Successful!")
+# Puts the parquet files of a finished conversion on uploads, keeping their S3 keys and paths in its manifest entry
+def queue_uploads(uploads, converted):
+    (entry, parquet_files) = converted
+    entry['parts'] = [[key, os.path.relpath(parquet_file, target_dir)] for (key, parquet_file) in parquet_files]
+    entry['pending'] = len(parquet_files)
+    if len(parquet_files) == 0:
+        with manifest_lock:
+            record_conversion(entry)
+    for (key, parquet_file) in parquet_files:
+        uploads.put((key, parquet_file, entry))
+
+# Yields the conversions, taking one of the slots before each, until stopped is set. The pool's task thread sends
+# conversions to the workers as fast as they are yielded, so this holds back the ones without a free slot.
+def bounded(conversions, slots, stopped):
+    for conversion in conversions:
+        slots.acquire()
+        if stopped.is_set():
+            return
+        yield conversion
+
+# Runs the conversions on the given number of workers, while upload_threads threads upload the converted files. With
+# more than one worker, the arrow engine converts in a pool of processes and the spark engine runs that many jobs at
+# once. A conversion frees its slot once its files are queued for upload, so no more than workers conversions are
+# sent to the pool ahead of the uploads, and conversion pauses while UPLOAD_QUEUE_SIZE converted files are waiting.
+def convert_all(conversions):
+    uploads = Queue(maxsize=UPLOAD_QUEUE_SIZE)
+    errors = []
+    uploaders = [threading.Thread(target=upload_worker, args=(uploads, errors)) for i in range(upload_threads)]
+    for uploader in uploaders:
+        uploader.daemon = True
+        uploader.start()
+    try:
+        if workers == 1:
+            for conversion in conversions:
+                queue_uploads(uploads, convert(conversion))
+        else:
+            if engine == "arrow":
+                pool = multiprocessing.Pool(workers, init_worker, (engine, arrow_block_size, layout, target_file_size))
+            else:
+                pool = ThreadPool(workers)
+            slots = threading.Semaphore(workers)
+            stopped = threading.Event()
+            try:
+                for converted in pool.imap_unordered(convert, bounded(conversions, slots, stopped)):
+                    queue_uploads(uploads, converted)
+                    slots.release()
+            finally:
+                stopped.set()
+                slots.release()
+                pool.terminate()
+    finally:
+        for uploader in uploaders:
+            uploads.put(None)
+        for uploader in uploaders:
+            uploader.join()
+    print(str.format("Uploaded {} files ({} bytes), skipped {} unchanged files ({} bytes)",
+                     upload_stats['files_sent'], upload_stats['bytes_sent'], upload_stats['files_skipped'], upload_stats['bytes_skipped']))
+    if len(errors) > 0:
+        raise errors[0]
+
+
+def start_spark(workers=1, worker_memory=WORKER_MEMORY):
+    # Set memory as needed
+    conf = (SparkConf()
+            .setMaster("local" if workers == 1 else str.format("local[{}]", workers))
+            .setAppName("CSV2Parquet")
+            .set("spark.executor.memory", "3g"))
+    if workers > 1:
+        conf.set("spark.driver.memory", str.format("{}m", workers * worker_memory))
+    sc = SparkContext(conf=conf)
+    return (sc, SQLContext(sc))
 
 
 def parse_args():
@@ -164,6 +627,18 @@ def parse_args():
     parser.add_argument("--directory", help="Path to directory containing agentExports folder. Default set to current directory.",
                         type=str, default=os.getcwd())
     parser.add_argument("--filters", help="List of agentIds for which exported data will be collected.", nargs='+', type=str)
+    parser.add_argument("--engine", help="Engine converting the CSV files: spark (default) runs Spark in local mode, arrow streams them with pyarrow without starting a JVM.",
+                        choices=sorted(ENGINES), default="spark")
+    parser.add_argument("--layout", help="Layout of the parquet files: agent (default) writes one file per agent and export type, partitioned writes "
+                        "files of about --target-file-size MB holding many agents, partitioned by export type and day. Requires --engine arrow.",
+                        choices=["agent", "partitioned"], default="agent")
+    parser.add_argument("--target-file-size", help="MB at which the partitioned layout starts a new parquet file. Default is " + str(TARGET_FILE_SIZE) + ".",
+                        type=int, default=TARGET_FILE_SIZE, dest="target_file_size")
+    parser.add_argument("--workers", help="Number of agent and export type conversions run in parallel. Default is 1.", type=int, default=1)
+    parser.add_argument("--worker-memory", help="MB of memory for each worker. Default is " + str(WORKER_MEMORY) + ".",
+                        type=int, default=WORKER_MEMORY, dest="worker_memory")
+    parser.add_argument("--upload-threads", help="Number of threads uploading parquet files to S3. Default is " + str(UPLOAD_THREADS) + ".",
+                        type=int, default=UPLOAD_THREADS, dest="upload_threads")
     parser.add_argument("bucket_name", metavar="bucket-name", help="Name of S3 bucket where exports converted to parquet format will be stored.", type=str)
     parser.add_argument("region", help="Region for S3 bucket.", type=str)
     return parser.parse_args()
@@ -179,17 +654,31 @@ if __name__ == '__main__':
         print("Cannot find agentExports in given directory.")
         sys.exit(0)
 
-    # Set memory as needed
-    conf = (SparkConf()
-            .setMaster("local")
-            .setAppName("CSV2Parquet")
-            .set("spark.executor.memory", "3g"))
-    sc = SparkContext(conf=conf)
-    sqlContext = SQLContext(sc)
+    engine = args.engine
+    workers = args.workers
+    layout = args.layout
+    upload_threads = args.upload_threads
+    target_file_size = args.target_file_size * 1024 * 1024
+    if layout == "partitioned" and engine != "arrow":
+        print("The partitioned layout requires --engine arrow.")
+        sys.exit(1)
+    arrow_block_size = args.worker_memory * 1024 * 1024 // ARROW_MEMORY_FACTOR
+    if boto3 is None:
+        print("Uploading to S3 requires boto3; install it with pip install boto3.")
+        sys.exit(1)
+    if engine == "spark":
+        if SparkContext is None:
+            print("The spark engine requires pyspark; install it with pip install pyspark.")
+            sys.exit(1)
+        (sc, sqlContext) = start_spark(workers, args.worker_memory)
+    elif pyarrow is None:
+        print("The arrow engine requires pyarrow; install it with pip install pyarrow.")
+        sys.exit(1)
 
     target_dir = os.path.join(dir_path, "parquetExports")
     #s3 = boto3.client('s3', aws_access_key_id="ACCESSKEY", aws_secret_access_key="SECRETACCESSKEY")
     s3 = boto3.client('s3')
+    transfer_config = TransferConfig(multipart_threshold=MULTIPART_SIZE, multipart_chunksize=MULTIPART_SIZE, max_concurrency=MULTIPART_CONCURRENCY)
     try:
         s3.create_bucket(Bucket=bucket_name, CreateBucketConfiguration={'LocationConstraint': region})
     except Exception as e:
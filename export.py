@@ -11,17 +11,80 @@ import boto3
 import datetime
 import sys
 import os
-from urllib2 import urlopen, URLError, HTTPError
+import io
+try:
+	from urllib2 import urlopen, Request, URLError, HTTPError
+	from httplib import HTTPException
+	import Queue
+except ImportError: # Python 3
+	from urllib.request import urlopen, Request
+	from urllib.error import URLError, HTTPError
+	from http.client import HTTPException
+	import queue as Queue
+from tempfile import SpooledTemporaryFile
 from zipfile import ZipFile
-import shutil
 import json
+import csv
+import glob
+import math
 import time
 import argparse
 import logging
-from StringIO import StringIO
+import threading
+import socket
 
 MAX_EXPORTS = 5			# Max number of concurrent export tasks
 MAX_DESCRIBE_AGENTS = 100	# Max number of results from describe agents
+MAX_DESCRIBE_EXPORTS = 100	# Max number of results from describe export tasks
+DOWNLOAD_WORKERS = 4		# Default number of threads downloading and extracting finished exports
+POLL_INTERVAL = 2		# Shortest number of seconds between status checks of an export task
+YOUNG_POLL_INTERVAL = 16	# Seconds between status checks of a just-started export task; halves as the task ages
+THROTTLE_WAIT = 8		# Seconds to hold off starting exports after hitting the concurrent export limit
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024	# Bytes read at a time when downloading an export
+DOWNLOAD_MEMORY = 64		# Default MB of each downloaded export kept in memory before spilling to a temporary file
+DOWNLOAD_TIMEOUT = 60		# Default seconds a download may wait on the connection before the try fails
+JOURNAL_FILE = "exportJournal.jsonl"	# Journal of export progress, kept in the export directory
+EXPORT_WINDOW = datetime.timedelta(days=3)	# First export window of each agent, and the fixed window the report compares against
+MIN_EXPORT_WINDOW = datetime.timedelta(hours=1)	# Shortest export window an agent's window can shrink to
+MAX_EXPORT_WINDOW = datetime.timedelta(days=30)	# Longest export window an agent's window can grow to
+WINDOW_GROWTH = 2		# Factor an agent's export window grows by after an export that covered all of it
+
+client = None			# Discovery client, created in __main__ (or replaced by a stub when testing)
+start_input = None
+end_input = None
+total_exports = 0
+max_download_memory = DOWNLOAD_MEMORY * 1024 * 1024
+download_timeout = DOWNLOAD_TIMEOUT
+# Agents from describe_agents whose first export has not been started yet
+agents_queue = []
+# Maps each agent whose export task holds a slot to [next start time, final end time, current exportId]
+exporting_agents = {}
+# Maps each agent whose finished export is being downloaded to [start time of that export, final end time, exportId]
+extracting_agents = {}
+# [agentId, next start time, final end time] of agents waiting for a slot to export their next window
+continuing_agents = []
+# Maps each exportId holding a slot to [time it was started, time of its next status check]
+export_checks = {}
+# Number of polling ticks, describe_export_tasks calls, throttled calls and exports that left IN_PROGRESS, over the whole run,
+# and the seconds starting exports was held off after the concurrent export limit was hit and status checks were
+# held up by throttled calls
+poll_stats = {'ticks': 0, 'api_calls': 0, 'throttles': 0, 'transitions': 0, 'hold_off_seconds': 0.0, 'throttle_delay_seconds': 0.0}
+# Maps each exportId whose status check was throttled to the time of the first throttled check
+throttled_checks = {}
+# Open journal file that run progress is appended to, or None to keep no journal
+journal = None
+# Maps agentId to {window start time string: (actual start, actual end)} for windows extracted by earlier runs
+completed_windows = {}
+# With --incremental, maps agentId to the end of the newest export already extracted for it
+last_export_ends = {}
+# Maps agentId to the length of its next export window, adapted after each of its exports
+export_windows = {}
+# Most rows seen in an export the service cut short of its requested end, i.e. roughly what one export can hold
+max_export_rows = None
+# Maps agentId to [export tasks started, start of its first window, final end time] for report_windows
+window_stats = {}
+# Maps each agent, or batch of comma-separated agents, given up on after extracting an export failed to that exportId
+abandoned_agents = {}
 
 # Returns datetime of given time string; space = True for space between days and hours
 def get_time(time, space=False):
@@ -29,153 +92,588 @@ def get_time(time, space=False):
 		return datetime.datetime.strptime(time, '%Y-%m-%d %H:%M:%S')
 	return datetime.datetime.strptime(time,'%Y-%m-%dT%H:%M:%SZ')
 
+# Returns time as a string that get_time can parse, or None if time is None
+def format_time(time):
+	if time is None:
+		return None
+	return time.strftime('%Y-%m-%dT%H:%M:%SZ')
 
-# Begins export task for up to MAX_EXPORTS agents
-def start_exporting(count):
-	logging.debug(str.format("start_exporting - count={}, len(exporting_agents)={} (MAX_EXPORTS={}), len(agents_queue)={}", count, len(exporting_agents), MAX_EXPORTS, len(agents_queue)))
-	while len(exporting_agents) < MAX_EXPORTS and len(agents_queue) > 0:
-		agent = agents_queue.pop(0)
+# Appends an entry to the journal. Every change to an agent's progress is recorded before moving on, so that
+# an interrupted run can pick up where it stopped with --resume.
+def record(event, **entry):
+	if journal is None:
+		return
+	entry['event'] = event
+	journal.write(json.dumps(entry) + "\n")
+	journal.flush()
+	os.fsync(journal.fileno())
+
+# Returns the actual start and end time of an export from its parsed results file
+def get_export_times(results):
+	if 'ActualEndTime' in results['ExportSummary']:
+		return (get_time(results['ExportSummary']['ActualStartTime'], True), get_time(results['ExportSummary']['ActualEndTime'], True))
+	# If 0 result files exported, may not have elements in ExportSummary so take requested as actual
+	return (get_time(results['RequestedStartTime'], True), get_time(results['RequestedEndTime'], True))
+
+# Returns the actual end time of the newest export extracted for the agent in dir_name, or None if there is none.
+# Extracted files are prefixed with the start time of their export, so the newest one sorts last.
+# For a batch of comma-separated agentIds, returns the earliest such time of its agents.
+def get_last_export_end(dir_name, agent_id):
+	last_ends = []
+	for batch_agent_id in agent_id.split(","):
+		results_dir = os.path.join(dir_name, "agentExports", batch_agent_id, "results")
+		results_files = sorted(name for name in os.listdir(results_dir) if name.endswith(".json")) if os.path.isdir(results_dir) else []
+		if len(results_files) == 0:
+			return None
+		with open(os.path.join(results_dir, results_files[-1])) as results_file:
+			last_ends.append(get_export_times(json.load(results_file))[1])
+	return min(last_ends)
+
+# Keeps only the agents that reported to the service since their newest extracted export, and fills
+# last_export_ends so their exports continue from there. Returns the agents left to export.
+def get_incremental_agents(dir_name, agents):
+	remaining = []
+	for agent in agents:
+		last_end = get_last_export_end(dir_name, agent['agentId'])
+		if last_end is not None and get_time(agent['lastHealthPingTime']) <= last_end:
+			logging.info(str.format("Skipping agent {}: no health ping since its last export ended at {}", agent['agentId'], last_end))
+			continue
+		if last_end is not None:
+			last_export_ends[agent['agentId']] = last_end
+		remaining.append(agent)
+	logging.info(str.format("Incremental export: {} of {} agents have new data, {} of them were exported before", len(remaining), len(agents), len(last_export_ends)))
+	return remaining
+
+# Returns whether the files of the export window starting at start_time were extracted for the agent,
+# or for every agent of a batch of comma-separated agentIds
+def window_on_disk(dir_name, agent_id, start_time):
+	start_str = start_time.strftime('%Y-%m-%dT%H%M%SZ') + "_"
+	for batch_agent_id in agent_id.split(","):
+		if len(glob.glob(os.path.join(dir_name, "agentExports", batch_agent_id, "results", start_str + "*.json"))) == 0:
+			return False
+	return True
+
+# Replays the journal in dir_name, filling completed_windows with the windows of every run whose files are still on disk.
+# Returns the entry of the last run, or None if there is no journal, and maps each agent that run started to
+# {'next': next start time, 'final': final end time, 'exportId': exportId not yet extracted or None, 'done': bool}.
+def load_journal(dir_name):
+	global max_export_rows
+	run = None
+	agents_state = {}
+	path = os.path.join(dir_name, JOURNAL_FILE)
+	if not os.path.isfile(path):
+		return (run, agents_state)
+	with open(path) as journal_file:
+		for line in journal_file:
+			try:
+				entry = json.loads(line)
+			except ValueError: # last line may have been cut short by a crash
+				continue
+			agent_id = entry.get('agentId')
+			if entry['event'] == "run":
+				run = entry
+				agents_state = {}
+			elif entry['event'] == "export":
+				agents_state[agent_id] = {'next': get_time(entry['startTime']), 'final': get_time(entry['finalEndTime']), 'exportId': entry['exportId'], 'done': False}
+			elif entry['event'] == "window":
+				if agent_id in agents_state:
+					agents_state[agent_id]['next'] = get_time(entry['actualEnd'])
+					agents_state[agent_id]['exportId'] = None
+				if 'nextWindow' in entry:
+					export_windows[agent_id] = datetime.timedelta(seconds=entry['nextWindow'])
+					if entry['maxExportRows'] is not None: # None until an export was cut short
+						max_export_rows = max(max_export_rows or 0, entry['maxExportRows'])
+				if window_on_disk(dir_name, agent_id, get_time(entry['startTime'])):
+					completed_windows.setdefault(agent_id, {})[entry['startTime']] = (get_time(entry['actualStart']), get_time(entry['actualEnd']))
+			elif entry['event'] == "done":
+				agents_state.setdefault(agent_id, {})['done'] = True
+	return (run, agents_state)
+
+# Rebuilds the queues of an interrupted run from the agent states returned by load_journal. Exports that were
+# in flight are checked again right away. Returns the number of agents the interrupted run had started.
+def resume_exports(run, agents_state):
+	count = 0
+	now = time.time()
+	for agent in run['agents']:
+		agent_id = agent['agentId']
+		state = agents_state.get(agent_id)
+		if state is None:
+			agents_queue.append(agent)
+			continue
 		count += 1
-		logging.info(str.format("Starting export for agent {} ({}/{})", agent['agentId'], str(count), str(total_exports)))
-		reg_time = get_time(agent['registeredTime'])
-		last_health_time = get_time(agent['lastHealthPingTime'])
-		if start_input != None:
-			start_time = max(reg_time, start_input)
-		else:
-			start_time  = reg_time
-		if end_input != None:
-			final_end_time = min(last_health_time, end_input)
+		if state['done']:
+			continue
+		if state['exportId'] is not None:
+			exporting_agents[agent_id] = [state['next'], state['final'], state['exportId']]
+			export_checks[state['exportId']] = [now, now]
 		else:
-			final_end_time = last_health_time
+			continuing_agents.append([agent_id, state['next'], state['final']])
+	logging.info(str.format("Resuming run with {} agents not started, {} exporting and {} waiting for their next window", len(agents_queue), len(exporting_agents), len(continuing_agents)))
+	return count
+
+# Skips the windows of an agent that earlier runs already extracted, without any API calls. Returns the start time
+# of the first window left to export, or None if the agent has nothing left to export.
+def skip_exported_windows(agent_id, start_time, final_end_time):
+	windows = completed_windows.get(agent_id, {})
+	while format_time(start_time) in windows:
+		(actual_start, actual_end) = windows[format_time(start_time)]
+		logging.info(str.format("Skipping export for agent {} from {} to {}, already on disk", agent_id, actual_start, actual_end))
+		if actual_end == actual_start or actual_end >= final_end_time:
+			return None
+		start_time = actual_end
+	return start_time
 
+# Starts an export task for an agent, or a batch of comma-separated agentIds. Returns the exportId, or None if the
+# concurrent export limit was reached
+def start_export_task(agent_id, start_time, end_time):
+	try:
+		response = client.start_export_task(filters=[{'name': 'agentIds', 'values': agent_id.split(","), 'condition': 'EQUALS'}], 
+								startTime = start_time, endTime = end_time)
+		return response['exportId']
+	except Exception as e:
+		if (type(e).__name__ == "OperationNotPermittedException"):
+			last_word = str(e).split()[-1]
+			if last_word == "another.":
+				# Full message: You have reached limit of maximum allowed concurrent exports. Please wait for current export tasks to finish before starting another.
+				return None
+			# Full message: An error occurred (OperationNotPermittedException) when calling the StartExportTask operation: A successful export is already present Export ID: <export id>
+			logging.info(str.format("start_export_task - OperationNotPermittedException for agent {}: {}", agent_id, e))
+			return last_word
+		raise(e)
+
+# Returns the agents to export from describe_agents, following nextToken. Connectors are left out, and so are agents
+# whose agentId is not in filters if given.
+def describe_agents(filters):
+	agents = []
+	next_token = ""
+	while True:
+		response = client.describe_agents(maxResults=MAX_DESCRIBE_AGENTS, nextToken=next_token)
+		agents += [agent for agent in response['agentsInfo'] if (not filters or agent['agentId'] in filters) and
+					"connector" not in agent['agentType'].lower()]
+		if 'nextToken' not in response:
+			return agents
+		next_token = response['nextToken']
+
+# Returns the time range to export for an agent from describe_agents
+def get_export_range(agent):
+	reg_time = get_time(agent['registeredTime'])
+	last_health_time = get_time(agent['lastHealthPingTime'])
+	if start_input != None:
+		start_time = max(reg_time, start_input)
+	else:
+		start_time  = reg_time
+	if agent['agentId'] in last_export_ends:
+		start_time = max(start_time, last_export_ends[agent['agentId']])
+	if end_input != None:
+		final_end_time = min(last_health_time, end_input)
+	else:
+		final_end_time = last_health_time
+	return (start_time, final_end_time)
+
+# Groups agents whose export time ranges overlap into batches of up to batch_size agents that share one export task
+# per window. Each batch is returned as an agent whose agentId is the comma-separated agentIds of its agents and whose
+# registeredTime and lastHealthPingTime span the time ranges of all of them. A batch is exported from the earliest start
+# of its agents, which only adds no rows for agents that have no data before their own start. Agents continuing from an
+# export extracted before (see get_incremental_agents) do, so they are only batched with agents starting at the same time.
+def batch_agents(agents, batch_size):
+	batches = []
+	batch = []
+	for (start_time, final_end_time, agent) in sorted(((get_export_range(agent) + (agent,)) for agent in agents), key=lambda agent_range: agent_range[:2]):
 		if start_time >= final_end_time:
-			logging.info(str.format("Nothing to export for agent {} since registeredTime={} and lastHealthPingTime={}", agent['agentId'], reg_time, last_health_time))
 			continue
+		if len(batch) == batch_size or (len(batch) > 0 and (start_time >= min(agent_range[1] for agent_range in batch) or
+				(agent['agentId'] in last_export_ends and start_time > batch[0][0]))):
+			batches.append(make_batch(batch))
+			batch = []
+		batch.append((start_time, final_end_time, agent))
+	if len(batch) > 0:
+		batches.append(make_batch(batch))
+	logging.info(str.format("Grouped {} agents into {} export batches of up to {} agents", len(agents), len(batches), batch_size))
+	return batches
 
-		logging.info(str.format("Export for agent {} will start at {} (registeredTime={}) and end at {} (lastHealthPingTime={})", agent['agentId'], start_time, reg_time, final_end_time, last_health_time))
-		try:
-			response = client.start_export_task(filters=[{'name': 'agentIds', 'values': [agent['agentId']], 'condition': 'EQUALS'}], 
-									startTime = start_time, endTime = min(start_time + datetime.timedelta(days=3), final_end_time))
-			exporting_agents[agent['agentId']] = [start_time, final_end_time, response['exportId']]
-		except Exception as e:
-			if (type(e).__name__ == "OperationNotPermittedException"):
-				last_word = e.message.split()[-1]
-				if last_word == "another.":
-					# Full message: You have reached limit of maximum allowed concurrent exports. Please wait for current export tasks to finish before starting another.
-					agents_queue.insert(0, agent)
-					count -= 1
-					logging.info(str.format("start_exporting - Maximum number of concurrent exports exceeded. Requeuing agent {} and waiting...", agent['agentId']))
-					time.sleep(8)
-				else:
-					# Full message: An error occurred (OperationNotPermittedException) when calling the StartExportTask operation: A successful export is already present Export ID: <export id>
-					logging.info(str.format("start_exporting - OperationNotPermittedException for agent {}: {}", agent['agentId'], e.message))
-					exporting_agents[agent['agentId']] = [start_time, final_end_time, last_word]
+# Returns the agent entry exporting a batch of (start time, final end time, agent) for batch_agents
+def make_batch(batch):
+	if len(batch) == 1:
+		return batch[0][2]
+	return {'agentId': ",".join(agent['agentId'] for (start_time, final_end_time, agent) in batch), 'agentType': "batch",
+			'registeredTime': format_time(min(agent_range[0] for agent_range in batch)),
+			'lastHealthPingTime': format_time(max(agent_range[1] for agent_range in batch))}
+
+# Begins export tasks until MAX_EXPORTS slots are busy, giving agents with more windows to export priority over new agents.
+# Returns the updated count and whether the service turned an export away because of the concurrent export limit.
+def start_exporting(count):
+	logging.debug(str.format("start_exporting - count={}, len(exporting_agents)={} (MAX_EXPORTS={}), len(continuing_agents)={}, len(agents_queue)={}", count, len(exporting_agents), MAX_EXPORTS, len(continuing_agents), len(agents_queue)))
+	while len(exporting_agents) < MAX_EXPORTS and (len(continuing_agents) > 0 or len(agents_queue) > 0):
+		agent = None
+		if len(continuing_agents) > 0:
+			agent_id, start_time, final_end_time = continuing_agents.pop(0)
+		else:
+			agent = agents_queue.pop(0)
+			agent_id = agent['agentId']
+			count += 1
+			logging.info(str.format("Starting export for agent {} ({}/{})", agent_id, str(count), str(total_exports)))
+			reg_time = get_time(agent['registeredTime'])
+			last_health_time = get_time(agent['lastHealthPingTime'])
+			(start_time, final_end_time) = get_export_range(agent)
+
+			if start_time >= final_end_time:
+				logging.info(str.format("Nothing to export for agent {} since registeredTime={} and lastHealthPingTime={}", agent_id, reg_time, last_health_time))
+				record("done", agentId=agent_id)
+				continue
+
+			logging.info(str.format("Export for agent {} will start at {} (registeredTime={}) and end at {} (lastHealthPingTime={})", agent_id, start_time, reg_time, final_end_time, last_health_time))
+		start_time = skip_exported_windows(agent_id, start_time, final_end_time)
+		if start_time is None:
+			logging.info("Finished exporting agent " + agent_id)
+			record("done", agentId=agent_id)
+			continue
+		end_time = get_window_end(agent_id, start_time, final_end_time)
+		export_id = start_export_task(agent_id, start_time, end_time)
+		if export_id is None:
+			if agent is None:
+				continuing_agents.insert(0, [agent_id, start_time, final_end_time])
 			else:
-				raise(e)
-	return count
+				agents_queue.insert(0, agent)
+				count -= 1
+			logging.info(str.format("start_exporting - Maximum number of concurrent exports exceeded. Requeuing agent {} and holding off for {} seconds...", agent_id, THROTTLE_WAIT))
+			return (count, True)
+		exporting_agents[agent_id] = [start_time, final_end_time, export_id]
+		window_stats.setdefault(agent_id, [0, start_time, final_end_time])[0] += 1
+		record("export", agentId=agent_id, exportId=export_id, startTime=format_time(start_time), endTime=format_time(end_time), finalEndTime=format_time(final_end_time))
+		now = time.time()
+		export_checks[export_id] = [now, now + get_poll_interval(0)]
+	return (count, False)
+
+# Returns the end of the agent's export window starting at start_time
+def get_window_end(agent_id, start_time, final_end_time):
+	return min(start_time + export_windows.get(agent_id, EXPORT_WINDOW), final_end_time)
+
+# Sizes the agent's next export window after an export of rows rows was extracted. If the service ended the export
+# before the requested end, the next window asks for what it actually covered, and rows tells how much one export
+# can hold. Otherwise the window grows by WINDOW_GROWTH, but no further than the time the agent needs to produce
+# max_export_rows rows at its last rate, so busy agents are not cut short and quiet agents need few exports.
+def adapt_window(agent_id, start_time, final_end_time, actual_end, rows):
+	global max_export_rows
+	requested = get_window_end(agent_id, start_time, final_end_time) - start_time
+	covered = actual_end - start_time
+	if covered < requested:
+		max_export_rows = max(max_export_rows or 0, rows)
+		window = covered
+	else:
+		window = export_windows.get(agent_id, EXPORT_WINDOW) * WINDOW_GROWTH
+		if max_export_rows and rows > 0:
+			window = min(window, datetime.timedelta(seconds=covered.total_seconds() * max_export_rows / rows))
+	export_windows[agent_id] = min(max(window, MIN_EXPORT_WINDOW), MAX_EXPORT_WINDOW)
+
+# Logs how many export tasks each agent needed, next to how many fixed EXPORT_WINDOW windows would have taken at least
+def report_windows():
+	total_tasks = 0
+	total_fixed = 0
+	for agent_id in sorted(window_stats):
+		tasks, first_start, final_end_time = window_stats[agent_id]
+		fixed = int(math.ceil((final_end_time - first_start).total_seconds() / EXPORT_WINDOW.total_seconds()))
+		logging.debug(str.format("Window report - agent {}: {} export tasks from {} to {}, {} with fixed windows", agent_id, tasks, first_start, final_end_time, fixed))
+		total_tasks += tasks
+		total_fixed += fixed
+	logging.info(str.format("Started {} export tasks for {} agents; fixed {}-day windows would have needed at least {}", total_tasks, len(window_stats), EXPORT_WINDOW.days, total_fixed))
+
+# Returns the number of seconds until an export task that has been running for age seconds is checked again.
+# Exports rarely finish right after being started, so young exports are checked every YOUNG_POLL_INTERVAL seconds,
+# and the interval halves for every YOUNG_POLL_INTERVAL seconds of age until it reaches POLL_INTERVAL.
+def get_poll_interval(age):
+	return max(POLL_INTERVAL, YOUNG_POLL_INTERVAL / 2.0 ** int(age / YOUNG_POLL_INTERVAL))
+
+# Returns whether e means the service throttled the API call
+def is_throttling(e):
+	if type(e).__name__ == "ThrottlingException":
+		return True
+	return getattr(e, 'response', {}).get('Error', {}).get('Code') == "ThrottlingException"
+
+# Returns the exportsInfo of all given exports, following nextToken; every call made is counted in tick
+def describe_exports(export_ids, tick):
+	exports_info = []
+	next_token = ""
+	while True:
+		tick['api_calls'] += 1
+		response = client.describe_export_tasks(exportIds=export_ids, maxResults=MAX_DESCRIBE_EXPORTS, nextToken=next_token)
+		exports_info += response['exportsInfo']
+		if not response.get('nextToken'):
+			return exports_info
+		next_token = response['nextToken']
+
+# Checks the status of every export task holding a slot whose next check is due, all in one paginated
+# describe_export_tasks call. Succeeded exports give up their slot and are queued for the download workers.
+# Returns the counters of this tick, which are also added to poll_stats.
+def poll_exports(jobs):
+	now = time.time()
+	tick = {'polled': 0, 'api_calls': 0, 'throttles': 0, 'transitions': 0}
+	agents_by_export = dict((meta[2], agent_id) for agent_id, meta in exporting_agents.items() if export_checks[meta[2]][1] <= now)
+	if len(agents_by_export) == 0:
+		return tick
+	tick['polled'] = len(agents_by_export)
+	for export_id in agents_by_export:
+		export_checks[export_id][1] = now + get_poll_interval(now - export_checks[export_id][0])
 
-def poll_exports(dir_name):
 	done = []
-	for agent_id in exporting_agents:
-		logging.info("Trying to export data for " + agent_id + " from " + str(exporting_agents[agent_id][0]))
-		export_response = client.describe_export_tasks(exportIds=[exporting_agents[agent_id][2]], filters=[{'name': 'agentIds', 'values': [agent_id], 'condition': 'EQUALS'}])
-                if len(export_response['exportsInfo']) > 0:
-			exports_info = export_response['exportsInfo'][0]
-		else:
+	try:
+		exports_infos = describe_exports(list(agents_by_export), tick)
+		for export_id in agents_by_export:
+			if export_id in throttled_checks:
+				poll_stats['throttle_delay_seconds'] += time.time() - throttled_checks.pop(export_id)
+	except Exception as e:
+		if not is_throttling(e):
+			raise(e)
+		tick['throttles'] += 1
+		exports_infos = []
+		logging.info(str.format("poll_exports - describe_export_tasks was throttled; checking {} exports again in {} seconds", len(agents_by_export), YOUNG_POLL_INTERVAL))
+		for export_id in agents_by_export:
+			export_checks[export_id][1] = now + YOUNG_POLL_INTERVAL
+			throttled_checks.setdefault(export_id, now)
+	for exports_info in exports_infos:
+		agent_id = agents_by_export.get(exports_info['exportId'])
+		if agent_id is None:
 			continue
+		logging.info("Trying to export data for " + agent_id + " from " + str(exporting_agents[agent_id][0]))
 
-		# Extract data on successful export task
-		if exports_info['exportStatus'] in ["SUCCEEDED", "FAILED"]:
+		if exports_info['exportStatus'] == "SUCCEEDED":
 			logging.info(str.format("    export {}", exports_info['exportStatus']))
-			if exports_info['exportStatus'] == "SUCCEEDED":
-				(actual_start, actual_end) = extract_exports(exports_info, agent_id, dir_name)
-			else:
-				logging.info(str.format("exportId {}: {} - {}", exports_info['exportId'], exports_info['exportStatus'], exports_info['statusMessage']))
-				actual_end = exports_info['requestedEndTime'] if 'requestedEndTime' in exports_info else None
-			# Set new start time to be end time of completed export
-			exporting_agents[agent_id][0] = actual_end
-			# If actual end time past final end time or start/end times equal, export is done for agent
-			if exports_info['exportStatus'] == "FAILED" or actual_end == actual_start or actual_end >= exporting_agents[agent_id][1]:
-				logging.info("Finished exporting agent " + agent_id)
-				done.append(agent_id)
-			# Otherwise, go to next export
-			else:
-				next_start_time = actual_end
-				next_end_time = min(next_start_time + datetime.timedelta(days=3), exporting_agents[agent_id][1])
-				logging.info(str.format("Next export for agent {} will continue at {} and end at {}", agent_id, next_start_time, next_end_time))
-				try:
-					response = client.start_export_task(filters=[{'name': 'agentIds', 'values': [agent_id], 'condition': 'EQUALS'}], 
-											startTime = next_start_time, endTime = next_end_time)
-					exporting_agents[agent_id][2] = response['exportId']
-				# If successful export already exists, use exportId of existing export
-				except Exception as e:
-					if (type(e).__name__ == "OperationNotPermittedException"):
-						last_word = e.message.split()[-1]
-						if (last_word == "another."): # Too many concurrent exports
-							logging.info("poll_exports - Maximum number of concurrent exports exceeded. Waiting...")
-							time.sleep(8)
-						else: # Export already exists
-							logging.info(str.format("poll_exports - OperationNotPermittedException for agent {}: {}", agent_id, e.message))
-							exporting_agents[agent_id][2] = last_word
-					else:
-						raise(e)
+			tick['transitions'] += 1
+			del export_checks[exports_info['exportId']]
+			extracting_agents[agent_id] = exporting_agents.pop(agent_id)
+			jobs.put((exports_info, agent_id, extracting_agents[agent_id][0]))
+		elif exports_info['exportStatus'] == "FAILED":
+			logging.info(str.format("exportId {}: {} - {}", exports_info['exportId'], exports_info['exportStatus'], exports_info['statusMessage']))
+			logging.info("Finished exporting agent " + agent_id)
+			record("done", agentId=agent_id, exportId=exports_info['exportId'], status=exports_info['exportStatus'])
+			tick['transitions'] += 1
+			del export_checks[exports_info['exportId']]
+			done.append(agent_id)
 		elif exports_info['exportStatus'] == "IN_PROGRESS":
-                        logging.info("    In progress; waiting...")
+			logging.info("    In progress; waiting...")
 		else:
 			logging.info(str.format("ERROR: Unknown status for exportId {}: {} - {}", exports_info['exportId'], exports_info['exportStatus'], exports_info['statusMessage']))
 	for agent_id in done:
 		del exporting_agents[agent_id]
-	logging.debug(str.format("Exiting poll_exports - {} agents were done exporting, {} still exporting", len(done), len(exporting_agents)))
 
-def download_with_retry(url, num_retries=5):
+	poll_stats['ticks'] += 1
+	for counter in ['api_calls', 'throttles', 'transitions']:
+		poll_stats[counter] += tick[counter]
+	logging.debug(str.format("Exiting poll_exports - polled {} exports with {} API calls ({} throttled), {} changed status; {} agents were done exporting, {} still exporting, {} being extracted",
+				tick['polled'], tick['api_calls'], tick['throttles'], tick['transitions'], len(done), len(exporting_agents), len(extracting_agents)))
+	return tick
+
+# Body of each download thread: extracts the exports put on jobs and reports (agentId, actual start, actual end, rows, error) on events
+def download_worker(jobs, events, dir_name):
+	while True:
+		exports_info, agent_id, start_time = jobs.get()
+		try:
+			(actual_start, actual_end, rows) = extract_exports(exports_info, agent_id, dir_name, start_time)
+			events.put((agent_id, actual_start, actual_end, rows, None))
+		except Exception as e:
+			events.put((agent_id, None, None, 0, e))
+
+# Called once an agent's export has been extracted; queues the agent's next window if there is more to export
+def finish_extraction(agent_id, actual_start, actual_end, rows, error):
+	start_time, final_end_time, export_id = extracting_agents.pop(agent_id)
+	if error is not None:
+		# Nothing is journaled, so --resume will try this export again
+		logging.error(str.format("Giving up on agent {} after extracting exportId {} failed: {}", agent_id, export_id, error))
+		abandoned_agents[agent_id] = export_id
+		return
+	adapt_window(agent_id, start_time, final_end_time, actual_end, rows)
+	record("window", agentId=agent_id, exportId=export_id, startTime=format_time(start_time), actualStart=format_time(actual_start), actualEnd=format_time(actual_end),
+			rows=rows, nextWindow=export_windows[agent_id].total_seconds(), maxExportRows=max_export_rows)
+	# If actual end time past final end time or start/end times equal, export is done for agent
+	if actual_end == actual_start or actual_end >= final_end_time:
+		logging.info("Finished exporting agent " + agent_id)
+		record("done", agentId=agent_id)
+	# Otherwise, go to next export as soon as a slot is free
+	else:
+		logging.info(str.format("Next export for agent {} will continue at {} and end at {}", agent_id, actual_end, get_window_end(agent_id, actual_end, final_end_time)))
+		continuing_agents.append([agent_id, actual_end, final_end_time])
+
+# Runs exports for every agent in agents_queue. Status polling and starting exports happen on this thread while
+# num_workers threads download and extract finished exports, so a slow download never holds up a free slot.
+def run_exports(dir_name, num_workers=DOWNLOAD_WORKERS, count=0):
+	jobs = Queue.Queue()
+	events = Queue.Queue()
+	for i in range(num_workers):
+		worker = threading.Thread(target=download_worker, args=(jobs, events, dir_name), name="download-" + str(i))
+		worker.daemon = True
+		worker.start()
+
+	throttled_until = 0
+	throttled_at = None
+	while len(agents_queue) > 0 or len(continuing_agents) > 0 or len(exporting_agents) > 0 or len(extracting_agents) > 0:
+		logging.debug(str.format("Main export loop - {} agents in export queue, {} waiting for their next window, {} currently exporting, {} being extracted, count={}", len(agents_queue), len(continuing_agents), len(exporting_agents), len(extracting_agents), count))
+		if time.time() >= throttled_until:
+			if throttled_at is not None:
+				poll_stats['hold_off_seconds'] += time.time() - throttled_at
+				throttled_at = None
+			(count, throttled) = start_exporting(count)
+			if throttled:
+				throttled_at = time.time()
+				throttled_until = throttled_at + THROTTLE_WAIT
+		poll_exports(jobs)
+		next_poll = min([check[1] for check in export_checks.values()] or [time.time() + POLL_INTERVAL])
+		if len(continuing_agents) > 0 or len(agents_queue) > 0:
+			next_poll = min(next_poll, max(throttled_until, time.time() + POLL_INTERVAL))
+		# Wait for the next status check, waking up early when a download finishes so that agent's next window can start right away
+		try:
+			event = events.get(timeout=max(next_poll - time.time(), 0))
+			while True:
+				finish_extraction(*event)
+				event = events.get_nowait()
+		except Queue.Empty:
+			pass
+	report_windows()
+	logging.info(str.format("Polled export status {} times with {} describe_export_tasks calls ({} throttled); {} exports finished", poll_stats['ticks'], poll_stats['api_calls'], poll_stats['throttles'], poll_stats['transitions']))
+	logging.info(str.format("Held off starting exports for {:.1f} seconds at the concurrent export limit; throttling held up status checks for {:.1f} seconds in total",
+				poll_stats['hold_off_seconds'], poll_stats['throttle_delay_seconds']))
+	if len(abandoned_agents) > 0:
+		logging.error(str.format("Gave up on {} agents after downloading or extracting their exports failed: {}. Run again with --resume to export them.",
+					sum(len(agent_id.split(",")) for agent_id in abandoned_agents), ", ".join(sorted(abandoned_agents))))
+	return count
+
+# Downloads url into the file object target, DOWNLOAD_CHUNK_SIZE bytes at a time. When a try fails partway through,
+# the next one resumes from the last byte received with an HTTP Range request. Returns the number of bytes downloaded.
+def download_with_retry(url, target, num_retries=5):
+	received = 0
 	for num_retry in range(num_retries):
 		try:
 			time.sleep(num_retry**2) # exponential backoff
-			response = urlopen(url)
-		except HTTPError, e:
+			request = Request(url)
+			if received > 0:
+				request.add_header('Range', str.format('bytes={}-', received))
+			response = urlopen(request, timeout=download_timeout)
+			if received > 0 and response.getcode() != 206:
+				logging.info(str.format("download of {} cannot be resumed at byte {}; starting over", url, received))
+				target.seek(0)
+				target.truncate()
+				received = 0
+			content_length = response.info().get('Content-Length')
+			expected = received + int(content_length) if content_length else None
+			while True:
+				chunk = response.read(DOWNLOAD_CHUNK_SIZE)
+				if not chunk:
+					break
+				target.write(chunk)
+				received += len(chunk)
+			if expected is not None and received < expected:
+				raise HTTPException(str.format("connection closed after {} of {} bytes", received, expected))
+			return received
+		except HTTPError as e:
 			logging.error(str.format("download of {} failed on {}th retry with HTTP Error: {}", url, num_retry, e.code))
-		except URLError, e:
+			error = e
+		except URLError as e:
 			logging.error(str.format("download of {} failed on {}th retry with URL Error: {}", url, num_retry, e.reason))
-		else:
-			return response.read()
+			error = e
+		except (HTTPException, socket.error) as e:
+			logging.error(str.format("download of {} failed on {}th retry after {} bytes with error: {!r}", url, num_retry, received, e))
+			error = e
+	msg = str.format("Unable to download {} after {} tries: {!r}", url, num_retries, error)
+	logging.error(msg)
+	raise Exception(msg)
+
+# Opens file_name for writing in the agentExports subdirectory of the agent for the given export type, as bytes
+# like the archive the files come from, or as text for the csv module
+def open_export_file(dir_name, agent_id, subdir, file_name, mode='wb'):
+	target_dir = os.path.join(dir_name, "agentExports", agent_id, subdir)
+	try:
+		os.makedirs(target_dir)
+	except OSError: # already exists
+		pass
+	if mode == 'w' and sys.version_info[0] > 2:
+		return open(os.path.join(target_dir, file_name), mode, newline="", encoding="utf-8")
+	return open(os.path.join(target_dir, file_name), mode)
+
+# Copies source into the file target and closes it. Returns the number of lines copied.
+def copy_export_file(source, target):
+	lines = 0
+	with target:
+		while True:
+			chunk = source.read(DOWNLOAD_CHUNK_SIZE)
+			if not chunk:
+				break
+			target.write(chunk)
+			lines += chunk.count(b"\n")
+	return lines
+
+# Copies the results file of an export into the agent's results subdirectory under a temporary name, then renames it,
+# so a crash while writing it never leaves a partial results file
+def copy_results_file(source, dir_name, agent_id, file_name):
+	copy_export_file(source, open_export_file(dir_name, agent_id, "results", file_name + ".part"))
+	path = os.path.join(dir_name, "agentExports", agent_id, "results", file_name)
+	os.rename(path + ".part", path)
+
+# Splits a CSV file exported for a batch of agents by its agent_id column, writing each agent's rows under the
+# header into file_name in its own agentExports subdirectory. Returns the number of rows.
+def split_by_agent(source, dir_name, subdir, file_name):
+	if sys.version_info[0] > 2:
+		source = io.TextIOWrapper(source, encoding="utf-8", newline="")
+	reader = csv.reader(source)
+	header = next(reader, None)
+	if header is None:
+		return 0
+	columns = [column.lower().replace("_", "") for column in header]
+	agent_column = columns.index("agentid") if "agentid" in columns else 1
+	targets = {}
+	rows = 0
+	try:
+		for row in reader:
+			if len(row) <= agent_column:
+				continue
+			if row[agent_column] not in targets:
+				target = open_export_file(dir_name, row[agent_column], subdir, file_name, 'w')
+				targets[row[agent_column]] = (target, csv.writer(target, lineterminator="\n"))
+				targets[row[agent_column]][1].writerow(header)
+			targets[row[agent_column]][1].writerow(row)
+			rows += 1
+	finally:
+		for (target, writer) in targets.values():
+			target.close()
+	return rows
 
-# Returns actual end time
-def extract_exports(exports_info, agent_id, dir_name):
+# Returns the agentExports subdirectory of a file of an export archive, e.g. process for <accountNumber>_process.csv
+def get_archive_subdir(name):
+	return os.path.basename(name).split("_").pop().split(".")[0]
+
+# Returns actual start and end time of the export, whose files are labeled with start_time, and the number of CSV rows it held.
+# The files of an export for a batch of comma-separated agentIds are split up between its agents.
+def extract_exports(exports_info, agent_id, dir_name, start_time):
 	logging.debug(str.format("extracting {}, url={}", exports_info['exportId'], exports_info['configurationsDownloadUrl']))
-	zipped = download_with_retry(exports_info['configurationsDownloadUrl'])
-	if zipped is None:
-		msg = str.format("Unable to download {}", exports_info['configurationsDownloadUrl'])
-		logging.error(msg)
-		raise Exception(msg)
 	# String representing start time of export
 	actual_start = None
 	actual_end = None
-	export_meta = exporting_agents[agent_id]
-	start_time, end_time, curr_id = export_meta[0], export_meta[1], export_meta[2]
+	rows = 0
 	start_str = start_time.strftime('%Y-%m-%dT%H%M%SZ') + "_"
-	with ZipFile(StringIO(zipped)) as zip_ref:
-		for name in zip_ref.namelist():
-			basename = os.path.basename(name)
-			subdir = basename.split("_").pop().split(".")[0]
-			if subdir == "results":
-				json_file = zip_ref.open(name)
-				d = json.load(json_file)
-				if 'ActualEndTime' in d['ExportSummary']:
-					actual_start = get_time(d['ExportSummary']['ActualStartTime'], True)
-					actual_end = get_time(d['ExportSummary']['ActualEndTime'], True)
-				# If 0 result files exported, may not have elements in ExportSummary so take requested as actual
+	# Keep at most max_download_memory bytes of the archive in memory; anything larger spills to a temporary file
+	with SpooledTemporaryFile(max_size=max_download_memory) as zipped:
+		size = download_with_retry(exports_info['configurationsDownloadUrl'], zipped)
+		logging.debug(str.format("downloaded {} bytes for {}", size, exports_info['exportId']))
+		zipped.seek(0)
+		with ZipFile(zipped) as zip_ref:
+			# The results file goes last: --incremental and --resume take it to mean that all files of its export are
+			# on disk, so it must not be written before they are
+			for name in sorted(zip_ref.namelist(), key=lambda name: get_archive_subdir(name) == "results"):
+				basename = os.path.basename(name)
+				subdir = get_archive_subdir(name)
+				if subdir == "results":
+					json_file = zip_ref.open(name)
+					(actual_start, actual_end) = get_export_times(json.load(json_file))
+					for batch_agent_id in agent_id.split(","):
+						copy_results_file(zip_ref.open(name), dir_name, batch_agent_id, start_str + basename)
+				elif "," not in agent_id:
+					lines = copy_export_file(zip_ref.open(name), open_export_file(dir_name, agent_id, subdir, start_str + basename))
+					if basename.endswith(".csv"):
+						rows += max(lines - 1, 0) # minus the header
+				elif basename.endswith(".csv"):
+					rows += split_by_agent(zip_ref.open(name), dir_name, subdir, start_str + basename)
 				else:
-					actual_start = get_time(d['RequestedStartTime'], True)
-					actual_end = get_time(d['RequestedEndTime'], True)
-			target_dir = os.path.join(dir_name, "agentExports", agent_id, subdir)
-			try:
-				os.makedirs(target_dir)
-			except OSError: # already exists
-				pass
-			source = zip_ref.open(name)
-			with open(os.path.join(target_dir, start_str + basename), 'w') as target:
-				shutil.copyfileobj(source, target)
-	return (actual_start, actual_end)
+					# Every agent of the batch gets a copy of the other files
+					for batch_agent_id in agent_id.split(","):
+						copy_export_file(zip_ref.open(name), open_export_file(dir_name, batch_agent_id, subdir, start_str + basename))
+	return (actual_start, actual_end, rows)
 
 def parse_args():
 	parser = argparse.ArgumentParser()
@@ -187,6 +685,18 @@ def parse_args():
 						type=lambda d: datetime.datetime.strptime(d, '%Y-%m-%dT%H:%M'))
 	parser.add_argument("--filters", help="List of agentIds for which exported data will be collected.", nargs='+', type=str)
 	parser.add_argument("--log-file", help="File name where logs will be written, instead of the console", dest="log_file")
+	parser.add_argument("--download-workers", help="Number of threads downloading and extracting finished exports. Default is " + str(DOWNLOAD_WORKERS) + ".",
+						type=int, default=DOWNLOAD_WORKERS, dest="download_workers")
+	parser.add_argument("--max-download-memory", help="MB of each downloaded export archive kept in memory; larger archives are written to a temporary file. Default is " + str(DOWNLOAD_MEMORY) + ".",
+						type=int, default=DOWNLOAD_MEMORY, dest="max_download_memory")
+	parser.add_argument("--download-timeout", help="Seconds a download may wait for the server before it is retried, resuming from the last byte received. Default is " + str(DOWNLOAD_TIMEOUT) + ".",
+						type=float, default=DOWNLOAD_TIMEOUT, dest="download_timeout")
+	parser.add_argument("--batch-size", help="Number of agents with overlapping time ranges exported together by one export task. Default is 1.",
+						type=int, default=1, dest="batch_size")
+	parser.add_argument("--incremental", help="Start each agent's export at the end of the newest export already in the given directory, and skip agents with no health ping since then.",
+						action="store_true")
+	parser.add_argument("--resume", help="Continue the last run in the given directory where it stopped, using the agents and time range it was started with.",
+						action="store_true")
 	return parser.parse_args()
 
 if __name__ == '__main__':
@@ -196,6 +706,8 @@ if __name__ == '__main__':
 	end_input = args.end_time
 	filters = args.filters
 	log_file = args.log_file
+	max_download_memory = args.max_download_memory * 1024 * 1024
+	download_timeout = args.download_timeout
 
 	if log_file:
 		print(str.format("Debug log file {} configured; this will be the last message to the console.", log_file))
@@ -205,32 +717,37 @@ if __name__ == '__main__':
 
 	client = boto3.client('discovery')
 
-	logging.info(str.format("Querying Discovery Service for agents to export. directory={}, start_time={}, end_time={}, filters={}", dir_name, start_input, end_input, filters))
-	agents_queue = []
-	moreAgents = True
-	nextToken=""
-	while moreAgents:
-		response = client.describe_agents(maxResults=MAX_DESCRIBE_AGENTS, nextToken=nextToken)
-		if filters:
-			agents_queue += [agent for agent in response['agentsInfo'] if agent['agentId'] in filters and 
-						"connector" not in agent['agentType'].lower()]
-		else:
-			agents_queue += [agent for agent in response['agentsInfo'] if "connector" not in agent['agentType'].lower()]
-		if 'nextToken' in response:
-			nextToken = response['nextToken']
-		else:
-			moreAgents = False
+	try:
+		os.makedirs(dir_name)
+	except OSError: # already exists
+		pass
+	(last_run, agents_state) = load_journal(dir_name)
+	count = 0
+	if args.resume:
+		if last_run is None:
+			logging.error(str.format("Cannot resume: no {} found in {}", JOURNAL_FILE, dir_name))
+			sys.exit(1)
+		start_input = get_time(last_run['startTime']) if last_run['startTime'] else None
+		end_input = get_time(last_run['endTime']) if last_run['endTime'] else None
+		if last_run.get('incremental'):
+			get_incremental_agents(dir_name, last_run['agents'])
+		count = resume_exports(last_run, agents_state)
+		total_exports = len(last_run['agents'])
+		journal = open(os.path.join(dir_name, JOURNAL_FILE), 'a')
+	else:
+		logging.info(str.format("Querying Discovery Service for agents to export. directory={}, start_time={}, end_time={}, filters={}", dir_name, start_input, end_input, filters))
+		agents_queue = describe_agents(filters)
+		if args.incremental:
+			agents_queue = get_incremental_agents(dir_name, agents_queue)
+		if args.batch_size > 1:
+			agents_queue = batch_agents(agents_queue, args.batch_size)
+		total_exports = len(agents_queue)
+		journal = open(os.path.join(dir_name, JOURNAL_FILE), 'a')
+		record("run", startTime=format_time(start_input), endTime=format_time(end_input), filters=filters, incremental=args.incremental, agents=agents_queue)
 
-	#Maps each currently exporting agent to [next start time, final end time, current exportId]
-	exporting_agents = {}
-	total_exports = len(agents_queue)
 	logging.info("Beginning export for " + str(total_exports) + " agents.")
-	count = 0
-	count = start_exporting(count)
-	while len(agents_queue) > 0 or len(exporting_agents) > 0:
-		logging.debug(str.format("Main export loop - {} agents in export queue, {} agents currently waiting to export, count={}", len(agents_queue), len(exporting_agents), count))
-		poll_exports(dir_name)
-		time.sleep(2)
-		count = start_exporting(count)
+	run_exports(dir_name, args.download_workers, count)
+	journal.close()
+	if len(abandoned_agents) > 0:
+		sys.exit(1)
 	logging.info("Finished exporting all agents.")
-
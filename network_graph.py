@@ -0,0 +1,272 @@
+import os
+import sys
+import argparse
+import json
+import shutil
+import time
+from convert_csv import get_csv_files, get_source, read_export_file
+try:
+    import pyarrow
+    import pyarrow.compute
+    import pyarrow.parquet
+except ImportError: # only needed to build and load the graph
+    pyarrow = None
+
+GRAPH_DIR = "networkGraph" # Subdirectory of agentExports holding the graph
+MANIFEST_FILE = "graphManifest.jsonl" # Records which CSV files are already in the graph
+# Columns identifying an edge; first_seen, last_seen and count are aggregated over the connections of each edge
+EDGE_KEYS = ["src_agent", "src_process", "dst_agent", "dst_process", "port", "protocol"]
+# Export types read by the graph, in the order they are read: connections are resolved with the other three
+GRAPH_TYPES = ["networkInterface", "process", "destinationProcessConnection", "sourceProcessConnection"]
+MERGE_TABLES = 256 # Edges of this many connection files are merged at once while building
+
+# Returns the schemas of the tables of the graph: its edges, and the lookup tables used to resolve connections. Agents
+# and processes that cannot be resolved are represented by their IP address and agent_assigned_process_id.
+def get_schemas():
+    return {"edges": pyarrow.schema([("src_agent", pyarrow.string()), ("src_process", pyarrow.string()), ("dst_agent", pyarrow.string()),
+                                     ("dst_process", pyarrow.string()), ("port", pyarrow.int32()), ("protocol", pyarrow.string()),
+                                     ("first_seen", pyarrow.timestamp('ms')), ("last_seen", pyarrow.timestamp('ms')), ("count", pyarrow.int64())]),
+            # IP address of each agent, from networkInterface
+            "addresses": pyarrow.schema([("ip_address", pyarrow.string()), ("agent_id", pyarrow.string())]),
+            # Name of each process of each agent, from process
+            "processes": pyarrow.schema([("agent_id", pyarrow.string()), ("agent_assigned_process_id", pyarrow.string()), ("name", pyarrow.string())]),
+            # Process accepting connections on each port of each agent, from destinationProcessConnection
+            "listeners": pyarrow.schema([("agent_id", pyarrow.string()), ("port", pyarrow.int32()), ("protocol", pyarrow.string()), ("process", pyarrow.string())])}
+
+# Returns the table of the graph in graph_dir with the given name, empty if it was not written yet
+def read_table(graph_dir, name):
+    path = os.path.join(graph_dir, name + ".parquet")
+    if not os.path.isfile(path):
+        return get_schemas()[name].empty_table()
+    return pyarrow.parquet.read_table(path)
+
+def write_table(graph_dir, name, table):
+    pyarrow.parquet.write_table(table, os.path.join(graph_dir, name + ".parquet"))
+
+# Returns the distinct rows of the given tables
+def get_distinct(tables):
+    table = pyarrow.concat_tables(tables)
+    return table.group_by(table.column_names).aggregate([])
+
+# Returns the distinct rows of table and of the same columns of the given CSV files of an export type. Files are read
+# one at a time, keeping only their distinct rows.
+def add_distinct(table, export_files, export_type):
+    tables = [table]
+    for export_file in export_files:
+        tables.append(get_distinct([read_export_file(export_file, export_type).select(table.column_names)]))
+        if len(tables) >= MERGE_TABLES:
+            tables = [get_distinct(tables)]
+    return get_distinct(tables)
+
+# Returns table with a column name holding the value of mapping, a table of key columns followed by one value column,
+# for each row whose keys match. Rows without a match get null. Mappings with several values for a key use the least.
+def lookup(table, keys, mapping, name):
+    mapping_keys = mapping.column_names[:-1]
+    mapping = mapping.group_by(mapping_keys).aggregate([(mapping.column_names[-1], "min")])
+    mapping = mapping.rename_columns(mapping_keys + [name])
+    return table.join(mapping, keys, right_keys=mapping_keys, join_type="left outer")
+
+def is_loopback(ip_addresses):
+    return pyarrow.compute.or_(pyarrow.compute.starts_with(ip_addresses, "127."), pyarrow.compute.equal(ip_addresses, "::1"))
+
+# Returns rows with a column name holding the name of the process in its agent_id and agent_assigned_process_id
+# columns, or the agent_assigned_process_id if the process is unknown
+def get_process_names(rows, processes, name):
+    rows = lookup(rows, ["agent_id", "agent_assigned_process_id"], processes, "process_name")
+    names = pyarrow.compute.coalesce(rows["process_name"], rows["agent_assigned_process_id"], "")
+    return rows.append_column(name, names)
+
+# Returns the edges of the connections in rows of a sourceProcessConnection file, reported by the source agent. The
+# destination agent has the destination IP address (the source agent itself for loopback addresses), and the
+# destination process is the one accepting connections on the destination port of that agent.
+def get_source_edges(rows, addresses, processes, listeners):
+    rows = get_process_names(rows, processes, "src_process")
+    rows = lookup(rows, ["destination_ip"], addresses, "resolved_agent")
+    dst_agents = pyarrow.compute.if_else(is_loopback(rows["destination_ip"]), rows["agent_id"],
+                                         pyarrow.compute.coalesce(rows["resolved_agent"], rows["destination_ip"]))
+    rows = rows.append_column("dst_agent", dst_agents)
+    rows = lookup(rows, ["dst_agent", "destination_port", "transport_protocol"], listeners, "listener")
+    return pyarrow.table({"src_agent": rows["agent_id"], "src_process": rows["src_process"], "dst_agent": rows["dst_agent"],
+                          "dst_process": pyarrow.compute.coalesce(rows["listener"], ""), "port": rows["destination_port"],
+                          "protocol": rows["transport_protocol"], "seen": rows["agent_creation_date"]})
+
+# Returns the edges of the connections in rows of a destinationProcessConnection file whose source is not an agent.
+# Connections from agents are left to the sourceProcessConnection files of those agents, so none is counted twice.
+def get_destination_edges(rows, addresses, processes):
+    rows = lookup(rows, ["source_ip"], addresses, "resolved_agent")
+    rows = rows.filter(pyarrow.compute.and_(pyarrow.compute.is_null(rows["resolved_agent"]), pyarrow.compute.invert(is_loopback(rows["source_ip"]))))
+    rows = get_process_names(rows, processes, "dst_process")
+    return pyarrow.table({"src_agent": rows["source_ip"], "src_process": pyarrow.array([""] * rows.num_rows, pyarrow.string()),
+                          "dst_agent": rows["agent_id"], "dst_process": rows["dst_process"], "port": rows["destination_port"],
+                          "protocol": rows["transport_protocol"], "seen": rows["agent_creation_date"]})
+
+# Returns the listeners found in rows of a destinationProcessConnection file
+def get_listeners(rows, processes):
+    rows = get_process_names(rows, processes, "process")
+    return pyarrow.table({"agent_id": rows["agent_id"], "port": rows["destination_port"], "protocol": rows["transport_protocol"], "process": rows["process"]})
+
+# Returns one edge for each distinct EDGE_KEYS of the given edges, with the first and last time seen and count of connections
+def merge_edges(edges):
+    table = pyarrow.concat_tables(edges)
+    merged = table.group_by(EDGE_KEYS).aggregate([("first_seen", "min"), ("last_seen", "max"), ("count", "sum")])
+    merged = merged.rename_columns(EDGE_KEYS + ["first_seen", "last_seen", "count"])
+    return merged.sort_by([(key, "ascending") for key in EDGE_KEYS]).cast(get_schemas()["edges"])
+
+# Returns the edges of a table of connections with a seen column
+def aggregate_connections(connections):
+    edges = connections.group_by(EDGE_KEYS).aggregate([("seen", "min"), ("seen", "max"), ("seen", "count", pyarrow.compute.CountOptions(mode="all"))])
+    return edges.rename_columns(EDGE_KEYS + ["first_seen", "last_seen", "count"]).cast(get_schemas()["edges"])
+
+# Returns the covered sources of the manifest in graph_dir, as a dict of [size, mtime] by path
+def load_manifest(graph_dir):
+    covered = {}
+    path = os.path.join(graph_dir, MANIFEST_FILE)
+    if not os.path.isfile(path):
+        return covered
+    with open(path) as manifest_file:
+        for line in manifest_file:
+            try:
+                sources = json.loads(line)
+            except ValueError: # last line may have been cut short by a crash
+                continue
+            for source in sources:
+                covered[source[0]] = source[1:]
+    return covered
+
+# Adds the connections in the CSV files of the agentExports directory dir_path that are not in the graph yet to the
+# graph in its networkGraph subdirectory. The lookup tables are updated from the new files first, so connections are
+# resolved with everything known so far; a connection to an agent whose data is only added later keeps its IP address.
+# If a file already in the graph changed or is gone, the graph is built again from all files. Returns the number of
+# new files and edges.
+def build_graph(dir_path):
+    graph_dir = os.path.join(dir_path, GRAPH_DIR)
+    covered = load_manifest(graph_dir)
+    files = dict((export_type, get_csv_files(dir_path, export_type, None, None, None)) for export_type in GRAPH_TYPES)
+    current = dict((source[0], source[1:]) for export_type in GRAPH_TYPES for source in [get_source(dir_path, f) for f in files[export_type]])
+    if any(current.get(path) != stat for (path, stat) in covered.items()):
+        print("Files already in the network graph changed, building it again")
+        shutil.rmtree(graph_dir)
+        covered = {}
+    if not os.path.isdir(graph_dir):
+        os.makedirs(graph_dir)
+    new_files = dict((export_type, [f for f in files[export_type] if os.path.relpath(f, dir_path) not in covered]) for export_type in GRAPH_TYPES)
+    if sum(len(export_files) for export_files in new_files.values()) == 0:
+        return (0, read_table(graph_dir, "edges").num_rows)
+
+    tables = dict((name, read_table(graph_dir, name)) for name in get_schemas())
+    tables["addresses"] = add_distinct(tables["addresses"], new_files["networkInterface"], "networkInterface")
+    tables["addresses"] = tables["addresses"].filter(pyarrow.compute.invert(is_loopback(tables["addresses"]["ip_address"])))
+    tables["processes"] = add_distinct(tables["processes"], new_files["process"], "process")
+    # Connection files are read one at a time, and only their edges are kept
+    listeners = [tables["listeners"]]
+    edges = [tables["edges"]]
+    for export_file in new_files["destinationProcessConnection"]:
+        rows = read_export_file(export_file, "destinationProcessConnection")
+        listeners.append(get_distinct([get_listeners(rows, tables["processes"]).cast(get_schemas()["listeners"])]))
+        edges.append(aggregate_connections(get_destination_edges(rows, tables["addresses"], tables["processes"])))
+        if len(listeners) >= MERGE_TABLES:
+            listeners = [get_distinct(listeners)]
+        if len(edges) >= MERGE_TABLES:
+            edges = [merge_edges(edges)]
+    tables["listeners"] = get_distinct(listeners)
+    for export_file in new_files["sourceProcessConnection"]:
+        rows = read_export_file(export_file, "sourceProcessConnection")
+        edges.append(aggregate_connections(get_source_edges(rows, tables["addresses"], tables["processes"], tables["listeners"])))
+        if len(edges) >= MERGE_TABLES:
+            edges = [merge_edges(edges)]
+    tables["edges"] = merge_edges(edges)
+    for name in tables:
+        write_table(graph_dir, name, tables[name])
+    with open(os.path.join(graph_dir, MANIFEST_FILE), 'a') as manifest_file:
+        manifest_file.write(json.dumps([get_source(dir_path, f) for export_type in GRAPH_TYPES for f in new_files[export_type]]) + "\n")
+    return (sum(len(export_files) for export_files in new_files.values()), tables["edges"].num_rows)
+
+# The edges of a network graph, with lookups of the edges from, to and around an agent and on a port. The first lookup
+# on a column indexes it, so a lookup only takes the matching rows and a graph loaded for one lookup only indexes one column.
+class NetworkGraph(object):
+    def __init__(self, edges):
+        self.edges = edges
+        self.indexes = {}
+
+    # Returns the order of the edges sorted by column, or None if they already are, and the range of that order holding
+    # each value of the column. build_graph writes the edges sorted by EDGE_KEYS, so src_agent needs no sort.
+    def get_index(self, column):
+        if column not in self.indexes:
+            order = None
+            values = self.edges[column]
+            if column != EDGE_KEYS[0]:
+                order = pyarrow.compute.sort_indices(self.edges, sort_keys=[(column, "ascending")])
+                values = values.take(order)
+            # The values of a sorted column come in runs, which value_counts returns in order
+            runs = pyarrow.compute.value_counts(values)
+            ends = pyarrow.compute.cumulative_sum(runs.field("counts"))
+            starts = pyarrow.compute.subtract(ends, runs.field("counts"))
+            self.indexes[column] = (order, dict(zip(runs.field("values").to_pylist(), zip(starts.to_pylist(), ends.to_pylist()))))
+        return self.indexes[column]
+
+    def lookup(self, column, value):
+        (order, ranges) = self.get_index(column)
+        (start, end) = ranges.get(value, (0, 0))
+        if order is None:
+            return self.edges.slice(start, end - start)
+        return self.edges.take(order[start:end])
+
+    # Returns the edges from the given agent or IP address
+    def edges_from(self, agent):
+        return self.lookup("src_agent", agent)
+
+    # Returns the edges to the given agent or IP address
+    def edges_to(self, agent):
+        return self.lookup("dst_agent", agent)
+
+    # Returns the edges of connections to the given port
+    def edges_on_port(self, port):
+        return self.lookup("port", port)
+
+    # Returns the sorted agents and IP addresses connected to or from the given agent or IP address
+    def neighbors(self, agent):
+        neighbors = set(self.edges_from(agent)["dst_agent"].to_pylist()) | set(self.edges_to(agent)["src_agent"].to_pylist())
+        neighbors.discard(agent)
+        return sorted(neighbors)
+
+# Returns the NetworkGraph built by build_graph in the agentExports directory dir_path
+def load_graph(dir_path):
+    return NetworkGraph(read_table(os.path.join(dir_path, GRAPH_DIR), "edges"))
+
+# Writes each edge of a table as a JSON object on its own line
+def print_edges(edges):
+    for edge in edges.to_pylist():
+        print(json.dumps(edge, default=str, sort_keys=True))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Builds and queries the network dependency graph of the exported process connections.")
+    parser.add_argument("--directory", help="Path to directory containing agentExports folder. Default set to current directory.",
+                        type=str, default=os.getcwd())
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.add_parser("build", help="Add the connections of the CSV files exported since the last build to the graph.")
+    neighbors_parser = subparsers.add_parser("neighbors", help="Print the edges from and to an agent.")
+    neighbors_parser.add_argument("agent", help="AgentId, or IP address of a host without an agent.")
+    port_parser = subparsers.add_parser("port", help="Print the edges of connections to a port.")
+    port_parser.add_argument("port", type=int)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    dir_path = os.path.join(args.directory, "agentExports")
+    if not os.path.isdir(dir_path):
+        print("Cannot find agentExports in given directory.")
+        sys.exit(0)
+    if pyarrow is None:
+        print("The network graph requires pyarrow; install it with pip install pyarrow.")
+        sys.exit(1)
+    if args.command == "build":
+        started = time.time()
+        (new_files, edges) = build_graph(dir_path)
+        print(str.format("Added {} new CSV files to the network graph in {:.1f} seconds, it has {} edges", new_files, time.time() - started, edges))
+    elif args.command == "neighbors":
+        graph = load_graph(dir_path)
+        print_edges(pyarrow.concat_tables([graph.edges_from(args.agent), graph.edges_to(args.agent)]))
+    elif args.command == "port":
+        print_edges(load_graph(dir_path).edges_on_port(args.port))
@@ -0,0 +1,225 @@
+import os
+import sys
+import argparse
+import csv
+import datetime
+import json
+import math
+import time
+from convert_csv import get_csv_files, get_file_start, get_source, get_subdirs, is_agent_id, read_export_file
+try:
+    import pyarrow
+    import pyarrow.compute
+    import pyarrow.parquet
+except ImportError: # only needed to build the rollups
+    pyarrow = None
+
+ROLLUPS_DIR = os.path.join("parquetExports", "performanceRollups") # Subdirectory of agentExports holding the rollups
+MANIFEST_FILE = "rollupManifest.jsonl" # Records which systemPerformance CSV files are already in the rollups
+SUMMARY_FILE = "rightSizing.csv"
+PERIODS = {"hourly": "hour", "daily": "day"} # Rollup tables and the time unit of their periods
+# Utilization metrics rolled up, computed from the systemPerformance columns
+METRICS = ["cpu_pct", "ram_used_mb", "disk_kbps", "disk_iops", "network_kbps"]
+QUANTILES = [0.5, 0.95]
+TARGET_UTILIZATION = 70 # Default percentage of CPU and RAM the recommended sizes leave in use at the p95
+
+target_utilization = TARGET_UTILIZATION / 100.0
+
+# Returns the utilization metrics of rows of a systemPerformance file, with the capacity of the agent's host
+def get_metrics(rows):
+    add = pyarrow.compute.add
+    return pyarrow.table({"agent_id": rows["agent_id"], "timestamp": rows["timestamp"],
+                          "cpu_pct": rows["total_cpu_usage_pct"],
+                          "ram_used_mb": pyarrow.compute.subtract(rows["total_ram_in_mb"], rows["total_free_ram_in_mb"]),
+                          "disk_kbps": add(rows["total_disk_bytes_read_per_sec_in_kbps"], rows["total_disk_bytes_written_per_sec_in_kbps"]),
+                          "disk_iops": add(rows["total_disk_read_ops_per_sec"], rows["total_disk_write_ops_per_sec"]),
+                          "network_kbps": add(rows["total_network_bytes_read_per_sec_in_kbps"], rows["total_network_bytes_written_per_sec_in_kbps"]),
+                          "logical_processors": rows["total_num_logical_processors"], "ram_mb": rows["total_ram_in_mb"]})
+
+# Returns the p50, p95 and max of each metric, the number of samples and the capacity of the host for each period of the
+# given unit (hour or day) of an agent's metrics. Quantiles come from a t-digest, which is exact for the few samples
+# of an hour and very close for a day.
+def roll_up(metrics, unit):
+    metrics = metrics.append_column("period_start", pyarrow.compute.floor_temporal(metrics["timestamp"], unit=unit))
+    aggregations = [("timestamp", "count"), ("logical_processors", "max"), ("ram_mb", "max")]
+    for metric in METRICS:
+        aggregations += [(metric, "tdigest", pyarrow.compute.TDigestOptions(q=QUANTILES)), (metric, "max")]
+    grouped = metrics.group_by(["agent_id", "period_start"]).aggregate(aggregations)
+    columns = {"agent_id": grouped["agent_id"], "period_start": grouped["period_start"], "samples": grouped["timestamp_count"],
+               "logical_processors": grouped["logical_processors_max"], "ram_mb": grouped["ram_mb_max"]}
+    for metric in METRICS:
+        columns[metric + "_p50"] = pyarrow.compute.list_element(grouped[metric + "_tdigest"], 0)
+        columns[metric + "_p95"] = pyarrow.compute.list_element(grouped[metric + "_tdigest"], 1)
+        columns[metric + "_max"] = grouped[metric + "_max"]
+    table = pyarrow.table(columns)
+    return table.select(["agent_id", "period_start", "samples", "logical_processors", "ram_mb"] +
+                        [metric + suffix for metric in METRICS for suffix in ["_p50", "_p95", "_max"]]).sort_by("period_start")
+
+# Returns the days, as midnight timestamps, of the rows of a metrics table
+def get_days(metrics):
+    return pyarrow.compute.unique(pyarrow.compute.floor_temporal(metrics["timestamp"], unit="day").drop_null())
+
+# Returns the already rolled up files of an agent, sorted by start time, whose rows may fall on the given days. A file
+# holds rows from its export's start until the next file starts at the latest, since exports do not overlap.
+def get_overlapping_files(export_files, covered_files, days):
+    starts = [get_file_start(export_file) for export_file in export_files]
+    overlapping = []
+    for (n, export_file) in enumerate(export_files):
+        if export_file not in covered_files:
+            continue
+        end = starts[n + 1] if n < len(export_files) - 1 else None
+        if any(starts[n] < day + datetime.timedelta(days=1) and (end is None or end > day) for day in days):
+            overlapping.append(export_file)
+    return overlapping
+
+# Returns the rollup table of an agent with the given name, or None if it was not written yet
+def read_rollup(rollups_dir, name, agent):
+    path = os.path.join(rollups_dir, name, agent + ".parquet")
+    if not os.path.isfile(path):
+        return None
+    return pyarrow.parquet.read_table(path)
+
+# Returns the right-sizing summary of an agent from its daily rollup, using the busiest day's p95 of each metric
+def get_summary(daily):
+    def get_max(column):
+        value = pyarrow.compute.max(daily[column]).as_py()
+        return round(value, 2) if isinstance(value, float) else value
+    summary = {"agent_id": daily["agent_id"][0].as_py(), "first_day": daily["period_start"][0].as_py().date(),
+               "last_day": daily["period_start"][-1].as_py().date(), "samples": pyarrow.compute.sum(daily["samples"]).as_py(),
+               "logical_processors": get_max("logical_processors"), "ram_mb": get_max("ram_mb")}
+    for metric in METRICS:
+        summary[metric + "_p95"] = get_max(metric + "_p95")
+        summary[metric + "_max"] = get_max(metric + "_max")
+    return summary
+
+# Returns the vCPUs and MB of RAM that would run the p95 CPU and RAM use of a summary at target_utilization of the
+# host, or None where the summary lacks the values. Summaries read back from the summary file hold strings.
+def get_recommendations(summary):
+    def get_value(column):
+        return None if summary.get(column) in [None, ""] else float(summary[column])
+    (cpu_p95, ram_used_p95, logical_processors) = (get_value("cpu_pct_p95"), get_value("ram_used_mb_p95"), get_value("logical_processors"))
+    vcpus = None
+    if cpu_p95 is not None and logical_processors is not None:
+        vcpus = max(1, int(math.ceil(logical_processors * cpu_p95 / 100.0 / target_utilization)))
+    ram_mb = None if ram_used_p95 is None else int(math.ceil(ram_used_p95 / target_utilization))
+    return (vcpus, ram_mb)
+
+# Returns the covered files of each agent in the manifest in rollups_dir, as a dict by agent of dicts of [size, mtime] by path
+def load_manifest(rollups_dir):
+    covered = {}
+    path = os.path.join(rollups_dir, MANIFEST_FILE)
+    if not os.path.isfile(path):
+        return covered
+    with open(path) as manifest_file:
+        for line in manifest_file:
+            try:
+                entry = json.loads(line)
+            except ValueError: # last line may have been cut short by a crash
+                continue
+            if entry['rebuild']:
+                covered[entry['agent_id']] = {}
+            for source in entry['sources']:
+                covered.setdefault(entry['agent_id'], {})[source[0]] = source[1:]
+    return covered
+
+# Adds the systemPerformance CSV files of an agent that are not in its rollups yet. The days their rows fall on are
+# rolled up again from all files holding rows of those days, replacing the hours and days rolled up before, so
+# periods spanning two export windows stay exact. If a file already rolled up changed or is gone, all of the agent's
+# files are rolled up again. Only the agent's new files and files of those days are in memory at once. Returns the
+# manifest entry of the new files, or None if there are none.
+def update_agent(dir_path, rollups_dir, agent, covered):
+    export_files = get_csv_files(dir_path, "systemPerformance", [agent], None, None)
+    sources = [get_source(dir_path, export_file) for export_file in export_files]
+    current = dict((source[0], source[1:]) for source in sources)
+    rebuild = any(current.get(path) != stat for (path, stat) in covered.items())
+    if rebuild:
+        covered = {}
+    new_sources = [source for source in sources if source[0] not in covered]
+    if len(new_sources) == 0:
+        return None
+    new_files = [os.path.join(dir_path, source[0]) for source in new_sources]
+    metrics = [get_metrics(read_export_file(export_file, "systemPerformance")) for export_file in new_files]
+    days = get_days(pyarrow.concat_tables(metrics))
+    covered_files = set(os.path.join(dir_path, path) for path in covered)
+    for export_file in get_overlapping_files(export_files, covered_files, days.to_pylist()):
+        old_metrics = get_metrics(read_export_file(export_file, "systemPerformance"))
+        metrics.append(old_metrics.filter(pyarrow.compute.is_in(pyarrow.compute.floor_temporal(old_metrics["timestamp"], unit="day"), value_set=days)))
+    metrics = pyarrow.concat_tables(metrics)
+    for (name, unit) in PERIODS.items():
+        rollup = roll_up(metrics, unit)
+        existing = None if rebuild else read_rollup(rollups_dir, name, agent)
+        if existing is not None:
+            kept = pyarrow.compute.invert(pyarrow.compute.is_in(pyarrow.compute.floor_temporal(existing["period_start"], unit="day"), value_set=days))
+            rollup = pyarrow.concat_tables([existing.filter(kept), rollup.cast(existing.schema)]).sort_by("period_start")
+        if not os.path.isdir(os.path.join(rollups_dir, name)):
+            os.makedirs(os.path.join(rollups_dir, name))
+        pyarrow.parquet.write_table(rollup, os.path.join(rollups_dir, name, agent + ".parquet"))
+    return {'agent_id': agent, 'rebuild': rebuild, 'sources': new_sources}
+
+# Writes the right-sizing summaries, by agentId, with their recommended sizes to the summary file in rollups_dir
+def write_summaries(rollups_dir, summaries):
+    columns = ["agent_id", "first_day", "last_day", "samples", "logical_processors", "ram_mb"] + \
+              [metric + suffix for metric in METRICS for suffix in ["_p95", "_max"]] + ["recommended_vcpus", "recommended_ram_mb"]
+    with open(os.path.join(rollups_dir, SUMMARY_FILE), 'w') as summary_file:
+        writer = csv.DictWriter(summary_file, columns)
+        writer.writeheader()
+        for agent in sorted(summaries):
+            (summaries[agent]["recommended_vcpus"], summaries[agent]["recommended_ram_mb"]) = get_recommendations(summaries[agent])
+            writer.writerow(summaries[agent])
+
+# Returns the right-sizing summaries in the summary file in rollups_dir, by agentId
+def read_summaries(rollups_dir):
+    path = os.path.join(rollups_dir, SUMMARY_FILE)
+    if not os.path.isfile(path):
+        return {}
+    with open(path) as summary_file:
+        return dict((row["agent_id"], row) for row in csv.DictReader(summary_file))
+
+# Rolls up the systemPerformance CSV files of the agents in the agentExports directory dir_path, or only those in
+# filters if given, that are not in the rollups yet, one agent at a time. Returns the number of agents updated.
+def build_rollups(dir_path, filters=None):
+    rollups_dir = os.path.join(dir_path, ROLLUPS_DIR)
+    if not os.path.isdir(rollups_dir):
+        os.makedirs(rollups_dir)
+    covered = load_manifest(rollups_dir)
+    summaries = read_summaries(rollups_dir)
+    updated = 0
+    with open(os.path.join(rollups_dir, MANIFEST_FILE), 'a') as manifest_file:
+        for agent in sorted(get_subdirs(dir_path)):
+            if not is_agent_id(agent) or (filters and agent not in filters):
+                continue
+            entry = update_agent(dir_path, rollups_dir, agent, covered.get(agent, {}))
+            if entry is None:
+                continue
+            summaries[agent] = get_summary(read_rollup(rollups_dir, "daily", agent))
+            manifest_file.write(json.dumps(entry) + "\n")
+            manifest_file.flush()
+            updated += 1
+    write_summaries(rollups_dir, summaries)
+    return updated
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Rolls up systemPerformance exports into hourly and daily utilization and right-sizing summaries.")
+    parser.add_argument("--directory", help="Path to directory containing agentExports folder. Default set to current directory.",
+                        type=str, default=os.getcwd())
+    parser.add_argument("--filters", help="List of agentIds for which rollups will be updated.", nargs='+', type=str)
+    parser.add_argument("--target-utilization", help="Percentage of CPU and RAM the recommended sizes leave in use at the p95. Default is " +
+                        str(TARGET_UTILIZATION) + ".", type=int, default=TARGET_UTILIZATION, dest="target_utilization")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    dir_path = os.path.join(args.directory, "agentExports")
+    if not os.path.isdir(dir_path):
+        print("Cannot find agentExports in given directory.")
+        sys.exit(0)
+    if pyarrow is None:
+        print("The rollups require pyarrow; install it with pip install pyarrow.")
+        sys.exit(1)
+    target_utilization = args.target_utilization / 100.0
+    started = time.time()
+    updated = build_rollups(dir_path, args.filters)
+    print(str.format("Updated the rollups of {} agents in {:.1f} seconds, the right-sizing summary is in {}", updated, time.time() - started,
+                     os.path.join(dir_path, ROLLUPS_DIR, SUMMARY_FILE)))
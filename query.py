@@ -0,0 +1,141 @@
+import os
+import sys
+import argparse
+import csv
+import datetime
+import json
+from convert_csv import EXPORT_TYPES, PARTITIONED_PREFIX, get_csv_files, get_subdirs, get_table_name, get_timestamp_column, prune_by_time
+try:
+    import duckdb
+except ImportError: # only needed to run queries
+    duckdb = None
+
+# Data the tables can be read from: the CSV files in agentExports, or the parquet files of convert_csv.py's agent or
+# partitioned layout in agentExports/parquetExports
+SOURCES = ["csv", "parquet", "partitioned"]
+FETCH_ROWS = 10000 # Rows of a result fetched from DuckDB at a time while writing it out
+
+# Returns the parquet files of an export type written by convert_csv.py with the agent layout for the given agents
+# between start and end. They are named <exportType>-<startTime>_<agentId>.parquet, one for each conversion of an agent.
+def get_parquet_files(dir_path, export_type, agents, start, end):
+    target_dir = os.path.join(dir_path, "parquetExports")
+    agent_files = {}
+    if os.path.isdir(target_dir):
+        for name in sorted(get_subdirs(target_dir)):
+            if not name.startswith(export_type + "-") or not name.endswith(".parquet"):
+                continue
+            agent = name[len(export_type) + 1:-len(".parquet")].split("_")[-1]
+            if not agents or agent in agents:
+                agent_files.setdefault(agent, []).append(os.path.join(target_dir, name, name[len(export_type) + 1:]))
+    parquet_files = []
+    for agent in sorted(agent_files):
+        parquet_files.extend(prune_by_time(agent_files[agent], start, end))
+    return parquet_files
+
+# Returns the parquet files of an export type written by convert_csv.py with the partitioned layout that may hold rows
+# before end. Rows of a dt partition start on that day but can run past it, so only later partitions are left out.
+def get_partitioned_files(dir_path, export_type, agents, start, end):
+    type_dir = os.path.join(dir_path, "parquetExports", PARTITIONED_PREFIX, export_type)
+    parquet_files = []
+    if os.path.isdir(type_dir):
+        for partition in sorted(get_subdirs(type_dir)):
+            if end is not None and partition[len("dt="):] > end.strftime('%Y-%m-%d'):
+                continue
+            partition_dir = os.path.join(type_dir, partition)
+            parquet_files.extend(os.path.join(partition_dir, name) for name in sorted(os.listdir(partition_dir)) if name.endswith(".parquet"))
+    return parquet_files
+
+# Functions listing the files of each source
+SOURCE_FILES = {"csv": get_csv_files, "parquet": get_parquet_files, "partitioned": get_partitioned_files}
+
+def quote(value):
+    return "'" + value.replace("'", "''") + "'"
+
+# Returns the SQL selecting the rows of an export type from the given files of a source, with the same columns as its
+# table in discovery_athena.ddl, plus dt for the partitioned source like discovery_athena_partitioned.ddl. CSV columns
+# are matched to the schema by position, like convert_csv.py does.
+def get_scan_sql(export_type, source, files):
+    fields = EXPORT_TYPES[export_type]
+    file_list = "[" + ", ".join(quote(export_file) for export_file in files) + "]"
+    if len(files) == 0:
+        columns = ", ".join(str.format("CAST(NULL AS {}) AS {}", column_type, name) for (name, column_type) in fields)
+        if source == "partitioned":
+            columns += ", CAST(NULL AS VARCHAR) AS dt"
+        return str.format("SELECT {} WHERE false", columns)
+    if source == "csv":
+        columns = ", ".join(str.format("{}: {}", quote(name), quote(column_type)) for (name, column_type) in fields)
+        return str.format("SELECT * FROM read_csv({}, header=true, auto_detect=false, columns={{{}}})", file_list, columns)
+    columns = ", ".join(name for (name, column_type) in fields)
+    if source == "partitioned":
+        return str.format("SELECT {}, dt FROM read_parquet({}, hive_partitioning=true)", columns, file_list)
+    return str.format("SELECT {} FROM read_parquet({})", columns, file_list)
+
+# Returns a DuckDB connection in which each export type is a view named like its Athena table (process,
+# network_interface, ...) over the files of the given source in the agentExports directory dir_path. Given agents,
+# start or end, files that cannot hold matching rows are not read at all and the views only return matching rows.
+# Filters on agent_id and timestamps in queries are pushed down to parquet files, skipping row groups by their statistics.
+def connect(dir_path, source="csv", agents=None, start=None, end=None):
+    connection = duckdb.connect()
+    for export_type in sorted(EXPORT_TYPES):
+        files = SOURCE_FILES[source](dir_path, export_type, agents, start, end)
+        conditions = []
+        if agents:
+            conditions.append(str.format("agent_id IN ({})", ", ".join(quote(agent) for agent in agents)))
+        if start is not None:
+            conditions.append(str.format("{} >= TIMESTAMP {}", get_timestamp_column(export_type), quote(str(start))))
+        if end is not None:
+            conditions.append(str.format("{} < TIMESTAMP {}", get_timestamp_column(export_type), quote(str(end))))
+        sql = get_scan_sql(export_type, source, files)
+        if conditions:
+            sql = str.format("SELECT * FROM ({}) WHERE {}", sql, " AND ".join(conditions))
+        connection.execute(str.format("CREATE VIEW {} AS {}", get_table_name(export_type), sql))
+    return connection
+
+# Runs sql on the connection and writes its result to output as CSV with a header, or as one JSON object per row.
+# Returns the number of rows.
+def write_result(connection, sql, output, output_format="csv"):
+    result = connection.execute(sql)
+    columns = [column[0] for column in result.description]
+    writer = csv.writer(output)
+    if output_format == "csv":
+        writer.writerow(columns)
+    count = 0
+    rows = result.fetchmany(FETCH_ROWS)
+    while rows:
+        for row in rows:
+            if output_format == "csv":
+                writer.writerow(row)
+            else:
+                output.write(json.dumps(dict(zip(columns, row)), default=str, sort_keys=True) + "\n")
+        count += len(rows)
+        rows = result.fetchmany(FETCH_ROWS)
+    return count
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Runs SQL on the exported data locally, with the tables of discovery_athena.ddl.")
+    parser.add_argument("--directory", help="Path to directory containing agentExports folder. Default set to current directory.",
+                        type=str, default=os.getcwd())
+    parser.add_argument("--source", help="Files to query: csv (default) reads the exported CSV files, parquet and partitioned read the files "
+                        "convert_csv.py wrote in parquetExports with the agent or partitioned layout.", choices=SOURCES, default="csv")
+    parser.add_argument("--filters", help="List of agentIds to query. Files of other agents are not read.", nargs='+', type=str)
+    parser.add_argument("--start-time", help="Only query rows from this time on, skipping files of earlier exports. Format: YYYY-MM-DDTHH:MM",
+                        type=lambda d: datetime.datetime.strptime(d, '%Y-%m-%dT%H:%M'))
+    parser.add_argument("--end-time", help="Only query rows before this time, skipping files of later exports. Format: YYYY-MM-DDTHH:MM",
+                        type=lambda d: datetime.datetime.strptime(d, '%Y-%m-%dT%H:%M'))
+    parser.add_argument("--format", help="Output format: csv (default) or json, one object per row.", choices=["csv", "json"], default="csv")
+    parser.add_argument("sql", help="SQL query to run. Reads it from standard input if not given.", nargs='?')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    dir_path = os.path.join(args.directory, "agentExports")
+    if not os.path.isdir(dir_path):
+        print("Cannot find agentExports in given directory.")
+        sys.exit(0)
+    if duckdb is None:
+        print("Queries require duckdb; install it with pip install duckdb.")
+        sys.exit(1)
+    connection = connect(dir_path, args.source, args.filters, args.start_time, args.end_time)
+    write_result(connection, args.sql or sys.stdin.read(), sys.stdout, args.format)
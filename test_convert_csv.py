@@ -0,0 +1,141 @@
+import os
+import sys
+import json
+import shutil
+import subprocess
+import tempfile
+import unittest
+import pyarrow.parquet
+import convert_csv
+from benchmark import FakeS3
+
+ACCOUNT_NUMBER = "123456789012"
+AGENTS = ["o-00000000000000001", "o-00000000000000002", "o-00000000000000003", "o-00000000000000004"]
+BUCKET = "test"
+
+# Writes a process CSV file of an agent for the export started at start, e.g. 2017-11-04T000100Z, with rows rows
+def write_export_file(dir_path, agent, start, rows=2, name="sshd"):
+    type_dir = os.path.join(dir_path, agent, "process")
+    if not os.path.isdir(type_dir):
+        os.makedirs(type_dir)
+    lines = ["account_number,agent_id,agent_assigned_process_id,is_system,name,cmd_line,path,agent_provided_timestamp"]
+    for i in range(rows):
+        lines.append(str.format("{},{},p{},false,{},{},/usr/sbin,2017-11-04 00:{:02d}:00", ACCOUNT_NUMBER, agent, i, name, name, i % 60))
+    path = os.path.join(type_dir, str.format("{}_{}_process.csv", start, ACCOUNT_NUMBER))
+    with open(path, 'w') as export_file:
+        export_file.write("\n".join(lines) + "\n")
+    return path
+
+class PartitionedManifestTest(unittest.TestCase):
+    def setUp(self):
+        self.dir_name = tempfile.mkdtemp()
+        self.dir_path = os.path.join(self.dir_name, "agentExports")
+        self.s3 = FakeS3(os.path.join(self.dir_name, "s3"))
+        for agent in AGENTS:
+            write_export_file(self.dir_path, agent, "2017-11-04T000100Z")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir_name)
+
+    # Converts agentExports with the partitioned layout like a run of convert_csv.py, and returns its upload_stats
+    def convert(self, filters=None):
+        convert_csv.engine = "arrow"
+        convert_csv.layout = "partitioned"
+        convert_csv.workers = 1
+        convert_csv.filters = filters
+        convert_csv.target_dir = os.path.join(self.dir_path, "parquetExports")
+        convert_csv.bucket_name = BUCKET
+        convert_csv.s3 = self.s3
+        for stat in convert_csv.upload_stats:
+            convert_csv.upload_stats[stat] = 0
+        convert_csv.get_parquet_files(self.dir_path)
+        return dict(convert_csv.upload_stats)
+
+    # Returns the S3 keys of the process partition of 2017-11-04 in the fake bucket
+    def get_keys(self):
+        partition = os.path.join(self.s3.root, BUCKET, "partitioned", "process", "dt=2017-11-04")
+        return sorted(name for name in os.listdir(partition) if name.endswith(".parquet"))
+
+    # Returns the agentIds of the rows of the process partition of 2017-11-04 in the fake bucket
+    def get_agents(self):
+        partition = os.path.join(self.s3.root, BUCKET, "partitioned", "process", "dt=2017-11-04")
+        return sorted(pyarrow.parquet.read_table(os.path.join(partition, key)).column("agent_id").to_pylist() for key in self.get_keys())
+
+    def test_new_file_adds_part(self):
+        self.convert()
+        write_export_file(self.dir_path, AGENTS[0], "2017-11-04T120100Z")
+        stats = self.convert()
+        self.assertEqual(stats['files_sent'], 1)
+        self.assertEqual(self.get_keys(), ["part-00000.parquet", "part-00001.parquet"])
+        self.assertEqual(sum(len(agents) for agents in self.get_agents()), 10)
+
+    def test_changed_file_rebuilds(self):
+        self.convert()
+        write_export_file(self.dir_path, AGENTS[0], "2017-11-04T120100Z")
+        self.convert()
+        write_export_file(self.dir_path, AGENTS[1], "2017-11-04T000100Z", rows=3)
+        stats = self.convert()
+        self.assertEqual(stats['files_sent'], 1)
+        # the rebuild writes a single part, so the S3 object of the second part is deleted
+        self.assertEqual(self.get_keys(), ["part-00000.parquet"])
+        self.assertEqual(len(self.get_agents()[0]), 11)
+
+    def test_filtered_rerun_keeps_partition(self):
+        self.convert()
+        stats = self.convert(filters=[AGENTS[0]])
+        self.assertEqual(stats['files_sent'] + stats['files_skipped'], 0)
+        self.assertEqual(self.get_agents(), [sorted(agent for agent in AGENTS for i in range(2))])
+        parquet_file = os.path.join(self.dir_path, "parquetExports", "partitioned", "process", "dt=2017-11-04", "part-00000.parquet")
+        self.assertEqual(pyarrow.parquet.read_table(parquet_file).num_rows, 8)
+
+    def test_lost_manifest_skips_unchanged_uploads(self):
+        self.convert()
+        os.remove(os.path.join(self.dir_path, "parquetExports", convert_csv.MANIFEST_FILE))
+        stats = self.convert()
+        self.assertEqual((stats['files_sent'], stats['files_skipped']), (0, 1))
+
+class UploadTest(unittest.TestCase):
+    def setUp(self):
+        self.dir_name = tempfile.mkdtemp()
+        self.parquet_file = os.path.join(self.dir_name, "part-00000.parquet")
+        with open(self.parquet_file, 'wb') as parquet_file:
+            parquet_file.write(b"parquet")
+        convert_csv.s3 = FakeS3(os.path.join(self.dir_name, "s3"))
+        convert_csv.bucket_name = BUCKET
+        for stat in convert_csv.upload_stats:
+            convert_csv.upload_stats[stat] = 0
+
+    def tearDown(self):
+        shutil.rmtree(self.dir_name)
+
+    def test_unchanged_file_is_skipped(self):
+        convert_csv.upload_parquet("key", self.parquet_file)
+        convert_csv.upload_parquet("key", self.parquet_file)
+        self.assertEqual(convert_csv.upload_stats, {'files_sent': 1, 'bytes_sent': 7, 'files_skipped': 1, 'bytes_skipped': 7})
+
+    def test_changed_file_is_sent(self):
+        convert_csv.upload_parquet("key", self.parquet_file)
+        with open(self.parquet_file, 'ab') as parquet_file:
+            parquet_file.write(b"!")
+        convert_csv.upload_parquet("key", self.parquet_file)
+        self.assertEqual(convert_csv.upload_stats, {'files_sent': 2, 'bytes_sent': 15, 'files_skipped': 0, 'bytes_skipped': 0})
+        self.assertEqual(convert_csv.s3.head_object(Bucket=BUCKET, Key="key")['Metadata'][convert_csv.MD5_METADATA], convert_csv.get_md5(self.parquet_file))
+
+    def test_md5_mismatch_is_sent(self):
+        # an object uploaded without the metadata is recognized by its ETag, but not once neither digest matches
+        convert_csv.s3.upload_file(self.parquet_file, BUCKET, "key")
+        convert_csv.upload_parquet("key", self.parquet_file)
+        self.assertEqual(convert_csv.upload_stats['files_skipped'], 1)
+        with open(os.path.join(convert_csv.s3.root, BUCKET, "key.metadata.json"), 'w') as metadata_file:
+            json.dump({'Metadata': {convert_csv.MD5_METADATA: "0" * 32}, 'ETag': '"' + "0" * 32 + '"'}, metadata_file)
+        convert_csv.upload_parquet("key", self.parquet_file)
+        self.assertEqual(convert_csv.upload_stats['files_sent'], 1)
+
+class DependencyTest(unittest.TestCase):
+    # The local tools take the schemas and CSV readers from convert_csv, without needing pyspark or boto3
+    def test_tools_import_without_spark_or_boto3(self):
+        code = "import sys; sys.modules['pyspark'] = None; sys.modules['boto3'] = None; import query, network_graph, performance_rollups"
+        subprocess.check_call([sys.executable, "-c", code], cwd=os.path.dirname(os.path.abspath(__file__)))
+
+if __name__ == '__main__':
+    unittest.main()
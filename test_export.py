@@ -0,0 +1,270 @@
+import os
+import datetime
+import io
+import json
+import shutil
+import socket
+import tempfile
+import threading
+import unittest
+import zipfile
+import export
+
+ACCOUNT_NUMBER = "123456789012"
+START = datetime.datetime(2017, 11, 4, 0, 1)
+AGENTS = ["o-00000000000000001", "o-00000000000000002"]
+
+# Returns an agent of describe_agents registered at registered and last seen at last_health_ping
+def make_agent(agent_id, registered, last_health_ping):
+	return {'agentId': agent_id, 'agentType': "EC2", 'registeredTime': export.format_time(registered), 'lastHealthPingTime': export.format_time(last_health_ping)}
+
+# Writes an archive laid out like the service's to path, exporting the agents from start to end: a process CSV file
+# with two rows of each agent, one of them with a quoted comma, and the results file
+def make_archive(path, start, end, agents=AGENTS):
+	rows = ["account_number,agent_id,agent_assigned_process_id,is_system,name,cmd_line,path,agent_provided_timestamp"]
+	for agent_id in agents:
+		rows.append(str.format('{},{},p1,false,sshd,"sshd -D, -e",/usr/sbin,{}', ACCOUNT_NUMBER, agent_id, start.strftime('%Y-%m-%d %H:%M:%S')))
+		rows.append(str.format('{},{},p2,false,java,java,/usr/bin,{}', ACCOUNT_NUMBER, agent_id, start.strftime('%Y-%m-%d %H:%M:%S')))
+	results = {'ExportSummary': {'ActualStartTime': start.strftime('%Y-%m-%d %H:%M:%S'), 'ActualEndTime': end.strftime('%Y-%m-%d %H:%M:%S')},
+			'RequestedStartTime': start.strftime('%Y-%m-%d %H:%M:%S'), 'RequestedEndTime': end.strftime('%Y-%m-%d %H:%M:%S')}
+	with zipfile.ZipFile(path, 'w') as archive:
+		archive.writestr(ACCOUNT_NUMBER + "_process.csv", "\n".join(rows) + "\n")
+		archive.writestr(ACCOUNT_NUMBER + "_results.json", json.dumps(results))
+
+# Clears the state export.py keeps in module globals between runs
+def reset_export():
+	for state in [export.exporting_agents, export.extracting_agents, export.export_checks, export.completed_windows, export.last_export_ends,
+			export.export_windows, export.window_stats, export.throttled_checks, export.abandoned_agents]:
+		state.clear()
+	del export.agents_queue[:]
+	del export.continuing_agents[:]
+	export.start_input = None
+	export.end_input = None
+	export.max_export_rows = None
+	export.journal = None
+
+# Stands in for the Discovery client: export tasks succeed right away with an archive made by make_archive
+class StubClient(object):
+	def __init__(self, dir_name):
+		self.dir_name = dir_name
+		self.tasks = {} # Maps exportId to (agentIds, start time, end time)
+
+	def start_export_task(self, filters, startTime, endTime):
+		export_id = str.format("export-{}", len(self.tasks) + 1)
+		self.tasks[export_id] = (filters[0]['values'], startTime, endTime)
+		return {'exportId': export_id}
+
+	def describe_export_tasks(self, exportIds, maxResults=100, nextToken=""):
+		exports_info = []
+		for export_id in exportIds:
+			(agents, start, end) = self.tasks[export_id]
+			path = os.path.join(self.dir_name, export_id + ".zip")
+			make_archive(path, start, end, agents)
+			exports_info.append({'exportId': export_id, 'exportStatus': "SUCCEEDED", 'statusMessage': "", 'configurationsDownloadUrl': "file://" + os.path.abspath(path)})
+		return {'exportsInfo': exports_info}
+
+class BatchTest(unittest.TestCase):
+	def setUp(self):
+		self.dir_name = tempfile.mkdtemp()
+		reset_export()
+
+	def tearDown(self):
+		shutil.rmtree(self.dir_name)
+
+	def test_split_by_agent(self):
+		path = os.path.join(self.dir_name, "export.zip")
+		make_archive(path, START, START + datetime.timedelta(days=1))
+		with zipfile.ZipFile(path) as archive:
+			rows = export.split_by_agent(archive.open(ACCOUNT_NUMBER + "_process.csv"), self.dir_name, "process", "split.csv")
+		self.assertEqual(rows, 4)
+		for agent_id in AGENTS:
+			with open(os.path.join(self.dir_name, "agentExports", agent_id, "process", "split.csv")) as split:
+				lines = split.read().splitlines()
+			self.assertEqual(len(lines), 3)
+			self.assertTrue(lines[0].startswith("account_number,agent_id,"))
+			self.assertTrue(all(("," + agent_id + ",") in line for line in lines[1:]))
+			self.assertIn('"sshd -D, -e"', lines[1])
+
+	def test_extract_batch_archive(self):
+		end = START + datetime.timedelta(hours=20)
+		path = os.path.join(self.dir_name, "export.zip")
+		make_archive(path, START, end)
+		exports_info = {'exportId': "export-1", 'configurationsDownloadUrl': "file://" + os.path.abspath(path)}
+		(actual_start, actual_end, rows) = export.extract_exports(exports_info, ",".join(AGENTS), self.dir_name, START)
+		self.assertEqual((actual_start, actual_end, rows), (START, end, 4))
+		prefix = START.strftime('%Y-%m-%dT%H%M%SZ') + "_" + ACCOUNT_NUMBER
+		for agent_id in AGENTS:
+			agent_dir = os.path.join(self.dir_name, "agentExports", agent_id)
+			self.assertEqual(os.listdir(os.path.join(agent_dir, "process")), [prefix + "_process.csv"])
+			self.assertEqual(export.get_last_export_end(self.dir_name, agent_id), end)
+		self.assertTrue(export.window_on_disk(self.dir_name, ",".join(AGENTS), START))
+
+	def test_interrupted_extraction(self):
+		path = os.path.join(self.dir_name, "export.zip")
+		make_archive(path, START, START + datetime.timedelta(hours=20), AGENTS[:1])
+		# list the results file before the CSV file, then fail while writing the CSV file
+		with zipfile.ZipFile(path) as archive:
+			files = [(name, archive.read(name)) for name in reversed(archive.namelist())]
+		with zipfile.ZipFile(path, 'w') as archive:
+			for (name, content) in files:
+				archive.writestr(name, content)
+		copy_export_file = export.copy_export_file
+		def failing_copy(source, target):
+			if target.name.endswith(".csv"):
+				target.close()
+				raise IOError("disk full")
+			return copy_export_file(source, target)
+		export.copy_export_file = failing_copy
+		try:
+			exports_info = {'exportId': "export-1", 'configurationsDownloadUrl': "file://" + os.path.abspath(path)}
+			self.assertRaises(IOError, export.extract_exports, exports_info, AGENTS[0], self.dir_name, START)
+		finally:
+			export.copy_export_file = copy_export_file
+		self.assertIsNone(export.get_last_export_end(self.dir_name, AGENTS[0]))
+		self.assertFalse(export.window_on_disk(self.dir_name, AGENTS[0], START))
+
+	def test_batch_agents(self):
+		end = START + datetime.timedelta(days=10)
+		agents = [make_agent("o-0000000000000000a", START, end), make_agent("o-0000000000000000b", START + datetime.timedelta(hours=1), end),
+				make_agent("o-0000000000000000c", START, end), make_agent("o-0000000000000000d", START, end)]
+		# c and d were exported before up to the same time, so their next exports must not start before it
+		export.last_export_ends["o-0000000000000000c"] = START + datetime.timedelta(days=1)
+		export.last_export_ends["o-0000000000000000d"] = START + datetime.timedelta(days=1)
+		batches = export.batch_agents(agents, 4)
+		self.assertEqual([batch['agentId'] for batch in batches], ["o-0000000000000000a,o-0000000000000000b", "o-0000000000000000c,o-0000000000000000d"])
+		self.assertEqual(batches[1]['registeredTime'], export.format_time(START + datetime.timedelta(days=1)))
+
+class JournalTest(unittest.TestCase):
+	def setUp(self):
+		self.dir_name = tempfile.mkdtemp()
+		reset_export()
+		self.intervals = (export.POLL_INTERVAL, export.YOUNG_POLL_INTERVAL)
+		export.POLL_INTERVAL = export.YOUNG_POLL_INTERVAL = 0.01
+
+	def tearDown(self):
+		if export.journal is not None:
+			export.journal.close()
+		(export.POLL_INTERVAL, export.YOUNG_POLL_INTERVAL) = self.intervals
+		reset_export()
+		shutil.rmtree(self.dir_name)
+
+	# Journals a run of three agents that was interrupted while the second window of the first agent was exporting:
+	# the second agent is done and the third was not started yet
+	def journal_interrupted_run(self, client):
+		(first, second, third) = ["o-0000000000000000a", "o-0000000000000000b", "o-0000000000000000c"]
+		agents = [make_agent(first, START, START + datetime.timedelta(days=6)), make_agent(second, START, START + datetime.timedelta(days=2)),
+				make_agent(third, START, START + datetime.timedelta(days=2))]
+		export.journal = open(os.path.join(self.dir_name, export.JOURNAL_FILE), 'a')
+		export.record("run", startTime=None, endTime=None, filters=None, incremental=False, agents=agents)
+		for (agent, end) in [(agents[0], START + export.EXPORT_WINDOW), (agents[1], START + datetime.timedelta(days=2))]:
+			export_id = client.start_export_task([{'name': 'agentIds', 'values': [agent['agentId']], 'condition': 'EQUALS'}], START, end)['exportId']
+			export.record("export", agentId=agent['agentId'], exportId=export_id, startTime=export.format_time(START), endTime=export.format_time(end),
+						finalEndTime=agent['lastHealthPingTime'])
+			exports_info = client.describe_export_tasks([export_id])['exportsInfo'][0]
+			(actual_start, actual_end, rows) = export.extract_exports(exports_info, agent['agentId'], self.dir_name, START)
+			export.record("window", agentId=agent['agentId'], exportId=export_id, startTime=export.format_time(START), actualStart=export.format_time(actual_start),
+						actualEnd=export.format_time(actual_end), rows=rows, nextWindow=export.EXPORT_WINDOW.total_seconds(), maxExportRows=None)
+		export.record("done", agentId=second)
+		export_id = client.start_export_task([{'name': 'agentIds', 'values': [first], 'condition': 'EQUALS'}], START + export.EXPORT_WINDOW, START + datetime.timedelta(days=6))['exportId']
+		export.record("export", agentId=first, exportId=export_id, startTime=export.format_time(START + export.EXPORT_WINDOW),
+					endTime=agents[0]['lastHealthPingTime'], finalEndTime=agents[0]['lastHealthPingTime'])
+		export.journal.close()
+		reset_export()
+		return (agents, export_id)
+
+	def test_resume(self):
+		client = StubClient(self.dir_name)
+		(agents, export_id) = self.journal_interrupted_run(client)
+		(run, agents_state) = export.load_journal(self.dir_name)
+		self.assertEqual(run['agents'], agents)
+		self.assertEqual(agents_state[agents[0]['agentId']], {'next': START + export.EXPORT_WINDOW, 'final': START + datetime.timedelta(days=6), 'exportId': export_id, 'done': False})
+		self.assertTrue(agents_state[agents[1]['agentId']]['done'])
+		self.assertNotIn(agents[2]['agentId'], agents_state)
+		self.assertEqual(sorted(export.completed_windows), [agents[0]['agentId'], agents[1]['agentId']])
+
+		self.assertEqual(export.resume_exports(run, agents_state), 2)
+		self.assertEqual(export.agents_queue, [agents[2]])
+		self.assertEqual(list(export.exporting_agents), [agents[0]['agentId']])
+		export.client = client
+		export.journal = open(os.path.join(self.dir_name, export.JOURNAL_FILE), 'a')
+		self.assertEqual(export.run_exports(self.dir_name, 1, 2), 3)
+		# The export in flight is checked again instead of started over, and only the third agent needs a new one
+		self.assertEqual(len(client.tasks), 4)
+		for (agent, windows) in [(agents[0], 2), (agents[1], 1), (agents[2], 1)]:
+			self.assertEqual(len(os.listdir(os.path.join(self.dir_name, "agentExports", agent['agentId'], "process"))), windows)
+		export.journal.close()
+		reset_export()
+		(run, agents_state) = export.load_journal(self.dir_name)
+		self.assertTrue(all(agents_state[agent['agentId']]['done'] for agent in agents))
+
+	def test_abandoned_agent(self):
+		client = StubClient(self.dir_name)
+		describe_export_tasks = client.describe_export_tasks
+		# The archive of the second agent is not a zip file, so extracting it fails
+		def describe_broken_export_tasks(exportIds, maxResults=100, nextToken=""):
+			response = describe_export_tasks(exportIds, maxResults, nextToken)
+			for exports_info in response['exportsInfo']:
+				if client.tasks[exports_info['exportId']][0] == [AGENTS[1]]:
+					with open(os.path.join(self.dir_name, exports_info['exportId'] + ".zip"), 'wb') as archive:
+						archive.write(b"not a zip file")
+			return response
+		client.describe_export_tasks = describe_broken_export_tasks
+		agents = [make_agent(agent_id, START, START + datetime.timedelta(days=1)) for agent_id in AGENTS]
+		export.client = client
+		export.journal = open(os.path.join(self.dir_name, export.JOURNAL_FILE), 'a')
+		export.record("run", startTime=None, endTime=None, filters=None, incremental=False, agents=agents)
+		export.agents_queue.extend(agents)
+		export.run_exports(self.dir_name, 1)
+		export.journal.close()
+		self.assertEqual(list(export.abandoned_agents), [AGENTS[1]])
+		reset_export()
+		# The abandoned agent is not done, so --resume exports it again
+		(run, agents_state) = export.load_journal(self.dir_name)
+		self.assertEqual([agents_state[agent_id]['done'] for agent_id in AGENTS], [True, False])
+
+class DownloadTest(unittest.TestCase):
+	def setUp(self):
+		self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		self.server.bind(("127.0.0.1", 0))
+		self.server.listen(2)
+		self.body = b"x" * (export.DOWNLOAD_CHUNK_SIZE * 3 // 2)
+		self.sent = export.DOWNLOAD_CHUNK_SIZE + 10 # Bytes sent before the first response stalls
+		self.requests = []
+		self.connections = []
+		self.timeout = export.download_timeout
+
+	def tearDown(self):
+		for connection in self.connections:
+			connection.close()
+		self.server.close()
+		export.download_timeout = self.timeout
+
+	# Answers the first request with part of the body and then stalls, and the second from the byte its Range asks for
+	def serve(self):
+		for n in range(2):
+			(connection, address) = self.server.accept()
+			self.connections.append(connection)
+			request = connection.recv(65536).decode("ascii")
+			self.requests.append(request)
+			if n == 0:
+				connection.sendall(str.format("HTTP/1.1 200 OK\r\nContent-Length: {}\r\n\r\n", len(self.body)).encode("ascii") + self.body[:self.sent])
+			else:
+				first = int(request.split("Range: bytes=")[1].split("-")[0])
+				connection.sendall(str.format("HTTP/1.1 206 Partial Content\r\nContent-Length: {}\r\n\r\n", len(self.body) - first).encode("ascii") + self.body[first:])
+				connection.close()
+
+	def test_stalled_download_resumes(self):
+		export.download_timeout = 0.2
+		server = threading.Thread(target=self.serve)
+		server.daemon = True
+		server.start()
+		target = io.BytesIO()
+		received = export.download_with_retry(str.format("http://127.0.0.1:{}/export.zip", self.server.getsockname()[1]), target, num_retries=2)
+		self.assertEqual(received, len(self.body))
+		self.assertEqual(target.getvalue(), self.body)
+		# Only whole chunks are kept from the stalled try
+		self.assertIn(str.format("Range: bytes={}-", export.DOWNLOAD_CHUNK_SIZE), self.requests[1])
+
+
+if __name__ == '__main__':
+	unittest.main()